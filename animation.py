@@ -0,0 +1,182 @@
+"""
+Streaming output of animation frames, into an animated PNG, or piped to an encoder.
+
+Frames are written as they come, so only the frame being written is in memory,
+however long the animation is.
+"""
+
+import os
+import io
+import zlib
+import struct
+import shutil
+import subprocess
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+CHUNK_HEADER = struct.Struct(">I4s")            # length, type
+ACTL = struct.Struct(">II")                     # frames, plays (0 is forever)
+FCTL = struct.Struct(">IIIIIHHBB")              # sequence, width, height, x, y,
+                                                # delay numerator, denominator, dispose, blend
+
+# extra encoder arguments by output file extension
+ENCODER_OPTIONS = {
+    # the pixel format most players can show
+    ".mp4": ["-pix_fmt", "yuv420p"],
+}
+
+def png_chunks(data):
+    "The (type, data) of each chunk of PNG data"
+    if not data.startswith(PNG_SIGNATURE):
+        raise Exception("Invalid PNG data!")
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, chunk_type = CHUNK_HEADER.unpack_from(data, position)
+        position += CHUNK_HEADER.size
+        yield (chunk_type, data[position:position + length])
+        position += length + 4
+
+class ApngWriter(object):
+    """
+    Write an animated PNG, frame by frame, from the PNG data of each frame
+
+    Each frame's compressed image data is copied into the animation as it is, so frames
+    are encoded once, by whoever makes the PNG data.  All frames must be the same size
+    and kind of PNG.
+    """
+
+    # what write_frame() takes
+    frame_format = "png"
+
+    def __init__(self, file_name, frames, fps=30, plays=0):
+        """
+        :param frames: the number of frames, corrected by close() if fewer are written
+        :param fps: frames per second
+        :param plays: how many times to play the animation, 0 for forever
+        """
+        self.open_file = open(file_name, "wb")
+        self.frames = frames
+        self.plays = plays
+        # delay between frames, in thousandths of a second
+        self.delay = max(1, min(0xFFFF, round(1000 / fps)))
+        self.header = None
+        self.written = 0
+        self.sequence = 0
+        self.actl_position = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_chunk(self, chunk_type, data):
+        self.open_file.write(CHUNK_HEADER.pack(len(data), chunk_type))
+        self.open_file.write(data)
+        self.open_file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def write_frame(self, data):
+        "Add a frame, given as PNG data"
+        chunks = list(png_chunks(data))
+        header = [chunk_data for chunk_type, chunk_data in chunks if chunk_type == b"IHDR"][0]
+        if self.header is None:
+            self.header = header
+            self.open_file.write(PNG_SIGNATURE)
+            self.write_chunk(b"IHDR", header)
+            self.actl_position = self.open_file.tell()
+            self.write_chunk(b"acTL", ACTL.pack(self.frames, self.plays))
+        elif header != self.header:
+            raise Exception("Frames must all be the same size and kind of PNG!")
+
+        width, height = struct.unpack_from(">II", header)
+        self.write_chunk(b"fcTL", FCTL.pack(
+                self.sequence, width, height, 0, 0, self.delay, 1000, 0, 0))
+        self.sequence += 1
+        for chunk_type, chunk_data in chunks:
+            if chunk_type != b"IDAT":
+                continue
+            if self.written == 0:
+                # the first frame is also the image shown without animation
+                self.write_chunk(b"IDAT", chunk_data)
+            else:
+                self.write_chunk(b"fdAT", struct.pack(">I", self.sequence) + chunk_data)
+                self.sequence += 1
+        self.written += 1
+
+    def write_image(self, image):
+        "Add a frame, given as a PIL Image"
+        open_file = io.BytesIO()
+        image.save(open_file, "PNG")
+        self.write_frame(open_file.getvalue())
+
+    def close(self):
+        if self.open_file.closed:
+            return
+        if self.header is not None:
+            self.write_chunk(b"IEND", b"")
+            if self.written != self.frames:
+                self.open_file.seek(self.actl_position)
+                self.write_chunk(b"acTL", ACTL.pack(self.written, self.plays))
+        self.open_file.close()
+
+class EncoderWriter(object):
+    """
+    Pipe raw RGB frames to an encoder process, ffmpeg, which writes the file in the
+    format of its extension, e.g. .mp4, .webm or .gif
+
+    The pipe holds only a little, so frames are written as fast as the encoder takes them.
+    """
+
+    # what write_frame() takes
+    frame_format = "rgb"
+
+    def __init__(self, file_name, size, fps=30, encoder="ffmpeg"):
+        """
+        :param size: (width, height) of every frame
+        :param fps: frames per second
+        """
+        self.size = size
+        command = [
+                encoder, "-loglevel", "error", "-y",
+                "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%dx%d" % size,
+                "-r", str(fps), "-i", "-"]
+        command += ENCODER_OPTIONS.get(os.path.splitext(file_name)[1].lower(), [])
+        command.append(file_name)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_frame(self, data):
+        "Add a frame, given as bytes of RGB pixels, row by row from the top"
+        if len(data) != self.size[0] * self.size[1] * 3:
+            raise Exception("Frames must all be %dx%d RGB!" % self.size)
+        self.process.stdin.write(data)
+
+    def write_image(self, image):
+        "Add a frame, given as a PIL Image"
+        self.write_frame(image.convert("RGB").tobytes())
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise Exception("encoder failed with status %d" % self.process.returncode)
+
+def open_writer(file_name, frames, size, fps=30):
+    """
+    A writer for an animation in file_name, by its extension: an ApngWriter for .png
+    and .apng, otherwise an EncoderWriter if ffmpeg is installed
+
+    :param frames: the number of frames
+    :param size: (width, height) of every frame
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in [".png", ".apng"]:
+        return ApngWriter(file_name, frames, fps)
+    if shutil.which("ffmpeg"):
+        return EncoderWriter(file_name, size, fps)
+    raise Exception("no encoder for %s, install ffmpeg or write .png" % file_name)
@@ -12,26 +12,42 @@ DESCRIPTION = """
 BitMap class
 """
 
-import array
-try:
-    from past.builtins import xrange
-except ImportError:
-    pass
+import mmap
+import struct
+import operator
+from math import gcd
+
+# bytes per word when scanning for set or clear bits
+WORD_BYTES = 8
+
+# bytes counted at once by select before narrowing down to words
+SELECT_BLOCK_BYTES = 4096
+
+# saved BitMap files are this header followed by the bytes of the bitmap
+FILE_MAGIC = b"BMAP"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<4sB3xQ")   # magic, version, size in bits
+
+# strides longer than this set bits one at a time, shorter ones build a whole-range mask
+STRIDE_LOOP_LIMIT = 256
 
 class BitMap(object):
     """
     BitMap class
+    bits are stored in a bytearray, bit i is bit (i % 8) of byte (i // 8),
+    so whole ranges of bits can be handled as one large little-endian integer
     """
 
     BITMASK = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80]
-    BIT_CNT = [bin(i).count("1") for i in xrange(256)]
+    BIT_CNT = [bin(i).count("1") for i in range(256)]
 
     def __init__(self, maxnum=0):
         """
         Create a BitMap
         """
         nbytes = (maxnum + 7) // 8
-        self.bitmap = array.array('B', [0 for i in range(nbytes)])
+        self.bitmap = bytearray(nbytes)
+        self.__mmap = None
 
     def __del__(self):
         """
@@ -39,6 +55,78 @@ class BitMap(object):
         """
         pass
 
+    def save(self, path):
+        """
+        Write the BitMap to a binary file, readable with load() or mmap()
+        """
+        with open(path, "wb") as open_file:
+            open_file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, self.size()))
+            open_file.write(self.bitmap)
+
+    @classmethod
+    def __read_header(cls, open_file):
+        header = open_file.read(FILE_HEADER.size)
+        if len(header) != FILE_HEADER.size:
+            raise Exception("Invalid bitmap file!")
+        magic, version, nbits = FILE_HEADER.unpack(header)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise Exception("Invalid bitmap file!")
+        return nbits
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a BitMap written by save() into memory
+        """
+        with open(path, "rb") as open_file:
+            bm = cls(cls.__read_header(open_file))
+            if open_file.readinto(bm.bitmap) != len(bm.bitmap):
+                raise Exception("Invalid bitmap file!")
+        return bm
+
+    @classmethod
+    def mmap(cls, path, writable=False, maxnum=None):
+        """
+        Open a BitMap file backed by the file itself, rather than reading it into memory
+        When writable, changes go straight to the file, and are seen by other processes mapping it.
+        When maxnum is given, a new file holding that many bits (all 0) is created first.
+        """
+        if maxnum is not None:
+            nbytes = (maxnum + 7) // 8
+            with open(path, "wb") as open_file:
+                open_file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, nbytes * 8))
+                open_file.truncate(FILE_HEADER.size + nbytes)
+
+        with open(path, "r+b" if writable else "rb") as open_file:
+            nbits = cls.__read_header(open_file)
+            mapped = mmap.mmap(open_file.fileno(), 0,
+                    access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        if len(mapped) < FILE_HEADER.size + nbits // 8:
+            mapped.close()
+            raise Exception("Invalid bitmap file!")
+
+        bm = cls()
+        bm.__mmap = mapped
+        bm.bitmap = memoryview(mapped)[FILE_HEADER.size:FILE_HEADER.size + nbits // 8]
+        return bm
+
+    def flush(self):
+        """
+        Write changes to a file backed BitMap out to the file
+        """
+        if self.__mmap is not None:
+            self.__mmap.flush()
+
+    def close(self):
+        """
+        Release the file behind a file backed BitMap, after which it is empty
+        """
+        if self.__mmap is not None:
+            self.bitmap.release()
+            self.bitmap = bytearray()
+            self.__mmap.close()
+            self.__mmap = None
+
     def set(self, pos):
         """
         Set the value of bit@pos to 1
@@ -49,7 +137,7 @@ class BitMap(object):
         """
         Reset the value of bit@pos to 0
         """
-        self.bitmap[pos // 8] &= ~self.BITMASK[pos % 8]
+        self.bitmap[pos // 8] &= 0xff ^ self.BITMASK[pos % 8]
 
     def flip(self, pos):
         """
@@ -57,11 +145,106 @@ class BitMap(object):
         """
         self.bitmap[pos // 8] ^= self.BITMASK[pos % 8]
 
-    def count(self):
+    def set_range(self, start, stop, step=1):
         """
-        Count bits set
+        Set the value of the bits at range(start, stop, step) to 1
         """
-        return sum([self.BIT_CNT[x] for x in self.bitmap])
+        self.__range(start, stop, step, True)
+
+    def clear_range(self, start, stop, step=1):
+        """
+        Reset the value of the bits at range(start, stop, step) to 0
+        """
+        self.__range(start, stop, step, False)
+
+    def __range(self, start, stop, step, value):
+        if step <= 0:
+            raise Exception("step must be positive")
+        size = self.size()
+        if stop > size:
+            stop = size
+        if start >= stop:
+            return
+        last = start + (stop - 1 - start) // step * step
+
+        # long strides touch few bits, so set them one at a time
+        if step > STRIDE_LOOP_LIMIT:
+            bm = self.bitmap
+            if value:
+                for pos in range(start, last + 1, step):
+                    bm[pos >> 3] |= 1 << (pos & 7)
+            else:
+                for pos in range(start, last + 1, step):
+                    bm[pos >> 3] &= 0xff ^ (1 << (pos & 7))
+            return
+
+        # build a mask of the bits from start to last, then apply it to those bytes at once
+        first = start >> 3
+        end = (last >> 3) + 1
+        nbits = last - start + 1
+        if step == 1:
+            mask = (1 << nbits) - 1
+        else:
+            # the pattern of bits repeats every lcm(step, 8) bits, a whole number of bytes
+            period = step * 8 // gcd(step, 8)
+            pattern = 0
+            for k in range(0, period, step):
+                pattern |= 1 << k
+            pattern = pattern.to_bytes(period // 8, 'little')
+            mask = int.from_bytes(pattern * ((nbits + period - 1) // period), 'little')
+            mask &= (1 << nbits) - 1
+        mask <<= start - (first << 3)
+
+        region = int.from_bytes(self.bitmap[first:end], 'little')
+        if value:
+            region |= mask
+        else:
+            region &= ~mask
+        self.bitmap[first:end] = region.to_bytes(end - first, 'little')
+
+    def count(self, start=0, stop=None):
+        """
+        Count bits set, only those at positions start <= pos < stop when given
+        """
+        if start == 0 and stop is None:
+            return int.from_bytes(self.bitmap, 'little').bit_count()
+
+        size = self.size()
+        if stop is None or stop > size:
+            stop = size
+        if start >= stop:
+            return 0
+        first = start >> 3
+        value = int.from_bytes(self.bitmap[first:(stop + 7) >> 3], 'little')
+        value >>= start - (first << 3)
+        value &= (1 << (stop - start)) - 1
+        return value.bit_count()
+
+    def select(self, k):
+        """
+        Return the position of the k-th bit set, counting from 0
+        this is the inverse of count(0, pos), count(0, select(k)) == k
+        """
+        if k < 0:
+            raise Exception("k must not be negative")
+        bm = self.bitmap
+        nbytes = len(bm)
+        for block in range(0, nbytes, SELECT_BLOCK_BYTES):
+            block_count = int.from_bytes(bm[block:block + SELECT_BLOCK_BYTES], 'little').bit_count()
+            if k >= block_count:
+                k -= block_count
+                continue
+            for word in range(block, min(block + SELECT_BLOCK_BYTES, nbytes), WORD_BYTES):
+                value = int.from_bytes(bm[word:word + WORD_BYTES], 'little')
+                word_count = value.bit_count()
+                if k >= word_count:
+                    k -= word_count
+                    continue
+                # drop the lowest k bits, the one left at the bottom is the answer
+                for i in range(k):
+                    value &= value - 1
+                return (word << 3) + (value & -value).bit_length() - 1
+        raise Exception("Fewer than k+1 bits are set")
 
     def size(self):
         """
@@ -79,32 +262,71 @@ class BitMap(object):
         """
         Test if any bit is set
         """
-        return self.count() > 0
+        return int.from_bytes(self.bitmap, 'little') != 0
 
     def none(self):
         """
         Test if no bit is set
         """
-        return self.count() == 0
+        return not self.any()
 
     def all(self):
         """
         Test if all bits are set
         """
-        return (self.count() + 7) // 8 * 8 == self.size()
+        return self.count() == self.size()
+
+    def iter_set(self, start=0, stop=None):
+        """
+        Iterate over the positions of bits set, in ascending order
+        """
+        return self.__iter_bits(start, stop, False)
+
+    def iter_clear(self, start=0, stop=None):
+        """
+        Iterate over the positions of bits not set, in ascending order
+        """
+        return self.__iter_bits(start, stop, True)
+
+    def __iter_bits(self, start, stop, invert):
+        size = self.size()
+        if stop is None or stop > size:
+            stop = size
+
+        bm = self.bitmap
+        word_bits = WORD_BYTES * 8
+        full = (1 << word_bits) - 1
+        pos = start - start % word_bits
+        while pos < stop:
+            b = pos >> 3
+            w = int.from_bytes(bm[b:b + WORD_BYTES], 'little')
+            if invert:
+                w ^= full
+            if pos < start:
+                w &= full << (start - pos)
+            if pos + word_bits > stop:
+                w &= (1 << (stop - pos)) - 1
+
+            # skip words with nothing to report, otherwise peel off the lowest bit until empty
+            while w:
+                low = w & -w
+                yield pos + low.bit_length() - 1
+                w ^= low
+            pos += word_bits
 
     def nonzero(self):
         """
         Get all non-zero bits
         """
-        return [i for i in xrange(self.size()) if self.test(i)]
+        return list(self.iter_set())
 
     def tostring(self):
         """
         Convert BitMap to string
         """
-        return "".join([("%s" % bin(x)[2:]).zfill(8)
-                        for x in self.bitmap[::-1]])
+        if not self.size():
+            return ""
+        return format(int.from_bytes(self.bitmap, 'little'), "0%db" % self.size())
 
     def __str__(self):
         """
@@ -112,6 +334,78 @@ class BitMap(object):
         """
         return self.tostring()
 
+    def __combine(self, other, op, nbytes):
+        """
+        Apply op to the two bitmaps as whole integers, giving nbytes of result
+        """
+        value = op(int.from_bytes(self.bitmap, 'little'), int.from_bytes(other.bitmap, 'little'))
+        value &= (1 << (nbytes * 8)) - 1
+        return value.to_bytes(nbytes, 'little')
+
+    def __new_from(self, data):
+        bm = self.__class__()
+        bm.bitmap = bytearray(data)
+        return bm
+
+    def __and__(self, other):
+        """
+        Bits set in both, the size of the smaller BitMap
+        """
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        return self.__new_from(self.__combine(other, operator.and_,
+            min(len(self.bitmap), len(other.bitmap))))
+
+    def __or__(self, other):
+        """
+        Bits set in either, the size of the larger BitMap
+        """
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        return self.__new_from(self.__combine(other, operator.or_,
+            max(len(self.bitmap), len(other.bitmap))))
+
+    def __xor__(self, other):
+        """
+        Bits set in exactly one, the size of the larger BitMap
+        """
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        return self.__new_from(self.__combine(other, operator.xor,
+            max(len(self.bitmap), len(other.bitmap))))
+
+    def __sub__(self, other):
+        """
+        Bits set in this BitMap but not the other, the size of this BitMap
+        """
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        return self.__new_from(self.__combine(other, lambda a, b: a & ~b, len(self.bitmap)))
+
+    def __iand__(self, other):
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        self.bitmap[:] = self.__combine(other, operator.and_, len(self.bitmap))
+        return self
+
+    def __ior__(self, other):
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        self.bitmap[:] = self.__combine(other, operator.or_, len(self.bitmap))
+        return self
+
+    def __ixor__(self, other):
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        self.bitmap[:] = self.__combine(other, operator.xor, len(self.bitmap))
+        return self
+
+    def __isub__(self, other):
+        if not isinstance(other, BitMap):
+            return NotImplemented
+        self.bitmap[:] = self.__combine(other, lambda a, b: a & ~b, len(self.bitmap))
+        return self
+
     def __getitem__(self, item):
         """
         Return a bit when indexing like a array
@@ -133,16 +427,14 @@ class BitMap(object):
         """
         Returns a hexadecimal string
         """
-        val = self.tostring()
-        st = "{0:0x}".format(int(val, 2))
-        return st.zfill(len(self.bitmap)*2)
+        return bytes(self.bitmap)[::-1].hex()
 
     @classmethod
     def fromhexstring(cls, hexstring):
         """
         Construct BitMap from hex string
         """
-        bitstring = format(int(hexstring, 16), "0" + str(len(hexstring)/4) + "b")
+        bitstring = format(int(hexstring, 16), "0%db" % (len(hexstring) * 4))
         return cls.fromstring(bitstring)
 
     @classmethod
@@ -150,11 +442,10 @@ class BitMap(object):
         """
         Construct BitMap from string
         """
+        if bitstring.strip("01"):
+            raise Exception("Invalid bit string!")
         nbits = len(bitstring)
         bm = cls(nbits)
-        for i in xrange(nbits):
-            if bitstring[-i-1] == '1':
-                bm.set(i)
-            elif bitstring[-i-1] != '0':
-                raise Exception("Invalid bit string!")
+        if nbits:
+            bm.bitmap[:] = int(bitstring, 2).to_bytes(len(bm.bitmap), 'little')
         return bm
@@ -1,17 +1,23 @@
 #!/usr/local/bin/python3
 
+import os
 import re
+import ast
 import math
+import pickle
+import hashlib
+from time import perf_counter
+from collections import OrderedDict
 
 __all__ = [
     # exceptions
-    'LexException', 'ParseException',
+    'LexException', 'ParseException', 'DiffException',
 
     # classes
-    'Expr', 'ExprSet',
+    'Expr', 'ExprSet', 'StagedExprSet', 'ExprCache', 'ExprProfiler',
 
     # extensions
-    'addBinaryOp',
+    'addBinaryOp', 'addFunction',
     ]
 
 ########################################
@@ -27,16 +33,32 @@ class ParseException(Exception):
 class EvalException(Exception):
     pass
 
+class DiffException(Exception):
+    pass
+
 class Expr(object):
-    def __init__(self, expr_text=None, tokens=None):
-        if not tokens:
-            tokens = lex(expr_text)
-        self.orig_tokens = tokens
-        self.__unparsed_tokens, self.orig_expr_tree = parse(tokens)
-        self.expr_tree = fold_constants(self.orig_expr_tree)
-        self.expr_func = tree_to_func(self.expr_tree)
-        if expr_text and self.__unparsed_tokens:
-            raise ParseException("error at " + repr(self.__unparsed_tokens))
+    def __init__(self, expr_text=None, tokens=None, pos=0, trees=None):
+        """
+        :param trees: (orig_expr_tree, expr_tree) of an earlier Expr, to skip lexing,
+            parsing and folding
+        """
+        if trees:
+            self.orig_expr_tree, self.expr_tree = trees
+            self.orig_tokens = None
+            self.__unparsed_tokens = None
+            self.__unparsed_pos = None
+        else:
+            if not tokens:
+                tokens = lex(expr_text)
+            parser = Parser(tokens, pos)
+            self.orig_expr_tree = parser.parse()
+            self.orig_tokens = tokens[pos:parser.pos]
+            self.__unparsed_tokens = tokens
+            self.__unparsed_pos = parser.pos
+            self.expr_tree = fold_constants(self.orig_expr_tree)
+        self.expr_func = tree_to_code(self.expr_tree)
+        if expr_text and self.__unparsed_pos < len(tokens):
+            raise ParseException("error at " + repr(parser.remaining()))
 
         # compute required variables
         self.var_names = set()
@@ -46,7 +68,12 @@ class Expr(object):
     def get_unparsed_tokens(self):
         tokens = self.__unparsed_tokens
         self.__unparsed_tokens = None
-        return tokens
+        if tokens is not None:
+            return tokens[self.__unparsed_pos:]
+
+    def get_unparsed_pos(self):
+        "Index of the first token after the expression"
+        return self.__unparsed_pos
 
     def eval(self, vs):
         return self.expr_func(vs)
@@ -55,29 +82,63 @@ class Expr(object):
         if self.expr_tree[0] == "assign":
             return self.expr_tree[1]
 
+    def diff(self, var):
+        """
+        The derivative of the expression by the variable var, as an Expr
+        an assignment to name becomes an assignment to diff_name(name, var)
+        """
+        expr_tree = fold_constants(diff_tree(self.expr_tree, var, {}))
+        return Expr(trees=(expr_tree, expr_tree))
+
 class ExprSet(object):
-    def __init__(self, expr_text=None, file_name=None):
-        if file_name:
-            tokens = lex_file(file_name)
-        else:
-            tokens = lex(expr_text)
+    def __init__(self, expr_text=None, file_name=None, tokens=None, trees=None):
+        """
+        Parse the expressions of expr_text, the file file_name, or tokens
+
+        :param trees: list of (orig_expr_tree, expr_tree) of the exprs of an earlier ExprSet,
+            to skip lexing, parsing and folding
+        """
         self.__exprs = []
         self.__name_to_expr = {}
-        while tokens:
-            new_expr = Expr(tokens=tokens)
-            self.__exprs.append(new_expr)
+        if trees is not None:
+            for expr_trees in trees:
+                self.__add_expr(Expr(trees=expr_trees))
+        else:
+            if file_name:
+                tokens = lex_file(file_name)
+            elif tokens is None:
+                tokens = lex(expr_text)
+            pos = 0
+            while pos < len(tokens):
+                new_expr = Expr(tokens=tokens, pos=pos)
+                self.__add_expr(new_expr)
 
-            name = new_expr.get_assigned_name()
-            if name:
-                self.__name_to_expr[name] = new_expr
+                pos = new_expr.get_unparsed_pos()
+                if pos < len(tokens) and tokens[pos][0] == "delim":
+                    pos += 1
+        self.__eval_all_funcs = {}
+        self.__eval_vectorized_funcs = {}
+        self.__eval_interval_funcs = {}
 
-            tokens = new_expr.get_unparsed_tokens()
-            if tokens and tokens[0][0] == "delim":
-                tokens = tokens[1:]
+    def __add_expr(self, new_expr):
+        self.__exprs.append(new_expr)
+        name = new_expr.get_assigned_name()
+        if name:
+            self.__name_to_expr[name] = new_expr
 
     def get_exprs(self):
         return self.__exprs
 
+    def get_trees(self, outputs=None):
+        """
+        The expr_trees of the set, with outputs only those the variables in outputs
+        depend on
+        """
+        expr_trees = [expr.expr_tree for expr in self.__exprs]
+        if outputs is None:
+            return expr_trees
+        return live_trees(expr_trees, outputs)
+
     def eval_for(self, name, missing=None):
         if name in self.__name_to_expr:
             vs = {}
@@ -86,8 +147,337 @@ class ExprSet(object):
         else:
             return missing
 
+    def eval_all(self, vs, outputs=None):
+        """
+        Evaluate the expressions in order, assigning variables in vs
+
+        :param outputs: if given, only evaluate the expressions these variables depend on
+        :return: list of the values of the expressions evaluated
+        """
+        key = outputs if outputs is None or type(outputs) is tuple else tuple(outputs)
+        if key not in self.__eval_all_funcs:
+            self.__eval_all_funcs[key] = trees_to_code(self.get_trees(outputs))
+        return self.__eval_all_funcs[key](vs)
+
+    def eval_vectorized(self, arrays, outputs=None):
+        """
+        Evaluate every expression once over numpy arrays of values
+
+        :param arrays: dict of variable values, each a numpy array or a scalar,
+            e.g. an array for 'theta' and scalars for 'time' and 'wave'
+        :param outputs: if given, only evaluate the expressions these variables depend on
+        :return: dict of the variables, including those assigned, which are arrays where
+            they depend on an array and scalars otherwise
+        """
+        key = outputs if outputs is None or type(outputs) is tuple else tuple(outputs)
+        if key not in self.__eval_vectorized_funcs:
+            self.__eval_vectorized_funcs[key] = trees_to_code(
+                    self.get_trees(outputs), vector_funcs())
+        vs = dict(arrays)
+        self.__eval_vectorized_funcs[key](vs)
+        return vs
+
+    def eval_interval(self, vs, outputs=None):
+        """
+        Evaluate every expression once over interval.Intervals of values, bounding each
+        variable for all the values of the variables it depends on
+
+        :param vs: dict of variable values, each an interval.Interval or a number
+        :param outputs: if given, only evaluate the expressions these variables depend on
+        :return: dict of the variables, including those assigned, which are Intervals
+            where they depend on an Interval and numbers otherwise
+        """
+        key = outputs if outputs is None or type(outputs) is tuple else tuple(outputs)
+        if key not in self.__eval_interval_funcs:
+            self.__eval_interval_funcs[key] = trees_to_code(
+                    self.get_trees(outputs), interval_funcs(), op_funcs=INTERVAL_BIN_OPS)
+        vs = dict(vs)
+        self.__eval_interval_funcs[key](vs)
+        return vs
+
+    def diff(self, var, order=1):
+        """
+        An ExprSet which also computes the derivatives by var of the variables assigned,
+        up to order, as diff_name(name, var), diff_name(diff_name(name, var), var), ...
+        """
+        return ExprSet(trees=[
+            (expr_tree, expr_tree)
+            for expr_tree in diff_trees(self.get_trees(), var, order)])
+
+    def specialize(self, slow_names, outputs=None):
+        """
+        Split the ExprSet by binding time, see StagedExprSet
+
+        :param slow_names: the variables that change slowly, e.g. 'time' and 'wave'
+        :param outputs: if given, only evaluate the expressions these variables depend on
+        """
+        return StagedExprSet(self, slow_names, outputs)
+
+class StagedExprSet(object):
+    """
+    An ExprSet split in two stages: everything depending only on the slow variables is
+    computed once by bind(), which returns a residual function of the other variables.
+    """
+
+    def __init__(self, expr_set, slow_names, outputs=None):
+        stager = Stager(slow_names)
+        self.residual_trees = [
+            stager.residual(*stager.split(expr_tree))
+            for expr_tree in expr_set.get_trees(outputs)]
+        self.stage_trees = stager.stage_trees
+        self.__stage_names = [stage_tree[1] for stage_tree in self.stage_trees]
+        self.__stage_func = trees_to_code(self.stage_trees)
+        self.__make_residual = trees_to_code(
+                self.residual_trees, closure_names=self.__stage_names)
+        self.__make_residual_vectorized = None
+
+    def bind(self, vs):
+        """
+        Evaluate stage one for the slow variables in vs
+
+        :return: function of vs like ExprSet.eval_all, for the other variables
+        """
+        return self.__make_residual(*self.__stage_func(dict(vs)))
+
+    def bind_vectorized(self, vs):
+        """
+        Evaluate stage one for the slow variables in vs
+
+        :return: function of arrays like ExprSet.eval_vectorized, for the other variables
+        """
+        if self.__make_residual_vectorized is None:
+            self.__make_residual_vectorized = trees_to_code(
+                    self.residual_trees, vector_funcs(), self.__stage_names)
+        residual_func = self.__make_residual_vectorized(*self.__stage_func(dict(vs)))
+        def residual(arrays):
+            vs = dict(arrays)
+            residual_func(vs)
+            return vs
+        return residual
+
+class ExprCache(object):
+    """
+    Cache of Exprs and ExprSets by their source text, and ops_version
+
+    Keeps the maxsize most recently used in memory, and if path is given, also stores
+    their parse trees in files in the directory path, so later runs skip lexing, parsing
+    and folding.  The trees are stored by a hash of the text and ops_signature(),
+    compiling them again is left to each run, as the compiled code refers to the
+    op functions.  The files are unpickled, so path must be a directory only trusted
+    users can write; it is made readable only by its owner.
+    """
+
+    FILE_VERSION = 1
+
+    def __init__(self, maxsize=256, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.__cache = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def get_expr(self, expr_text):
+        "Cached Expr(expr_text)"
+        return self.__get("expr", expr_text,
+                lambda: Expr(expr_text),
+                lambda expr: (expr.orig_expr_tree, expr.expr_tree),
+                lambda trees: Expr(trees=trees))
+
+    def get_expr_set(self, expr_text=None, file_name=None):
+        "Cached ExprSet(expr_text) or ExprSet(file_name=file_name), by the file's text"
+        if file_name:
+            with open(file_name) as open_file:
+                lines = open_file.readlines()
+            expr_text = "".join(lines)
+            make = lambda: ExprSet(tokens=lex_lines(lines))
+            kind = "file"
+        else:
+            make = lambda: ExprSet(expr_text)
+            kind = "expr_set"
+        return self.__get(kind, expr_text,
+                make,
+                lambda expr_set: [(expr.orig_expr_tree, expr.expr_tree)
+                    for expr in expr_set.get_exprs()],
+                lambda trees: ExprSet(trees=trees))
+
+    def clear(self):
+        "Empty the in-memory cache, leaving any files"
+        self.__cache.clear()
+
+    def __get(self, kind, expr_text, make, to_trees, from_trees):
+        key = (kind, expr_text, ops_version)
+        cache = self.__cache
+        if key in cache:
+            self.hits += 1
+            cache.move_to_end(key)
+            return cache[key]
+
+        file_path = None
+        value = None
+        if self.path:
+            digest = hashlib.sha256(
+                    repr((self.FILE_VERSION, kind, expr_text, ops_signature())).encode()).hexdigest()
+            file_path = os.path.join(self.path, digest + ".pickle")
+            value = self.__read(file_path, from_trees)
+        if value is None:
+            self.misses += 1
+            value = make()
+            if file_path:
+                self.__write(file_path, to_trees(value))
+        else:
+            self.disk_hits += 1
+
+        cache[key] = value
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return value
+
+    def __read(self, file_path, from_trees):
+        "The value stored in file_path, None if it is missing or can't be used"
+        try:
+            with open(file_path, "rb") as open_file:
+                trees = pickle.load(open_file)
+            return from_trees(trees)
+        except Exception:
+            # anything else in the file, e.g. from another version, is made again
+            return None
+
+    def __write(self, file_path, trees):
+        temp_path = "%s.%d.tmp" % (file_path, os.getpid())
+        try:
+            with open(temp_path, "wb") as open_file:
+                pickle.dump(trees, open_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, file_path)
+        except (OSError, pickle.PickleError):
+            # a cache that can't be written is only slower
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+class ExprProfiler(object):
+    """
+    Evaluates an Expr or ExprSet like eval/eval_all, counting the calls and timing each
+    node of their trees, and each assignment
+
+    Profiling uses its own closures, in the style of tree_to_func, so the compiled
+    Expr and ExprSet are untouched and cost nothing extra.  Times include the timing of
+    the nodes below, so compare nodes with each other rather than with unprofiled runs.
+    Identical subtrees, which the compiled code evaluates once, are timed at each use.
+    """
+
+    def __init__(self, expr_or_set, outputs=None, vectorized=False):
+        """
+        :param expr_or_set: an Expr, ExprSet, or StagedExprSet, whose stage one trees
+            are evaluated before its residual trees, as bind() and the function it
+            returns evaluate them
+        :param outputs: for an ExprSet, only evaluate the expressions these variables
+            depend on
+        :param vectorized: evaluate over numpy arrays, as eval_vectorized does
+        """
+        if isinstance(expr_or_set, Expr):
+            expr_trees = [expr_or_set.expr_tree]
+        elif isinstance(expr_or_set, StagedExprSet):
+            expr_trees = expr_or_set.stage_trees + expr_or_set.residual_trees
+        else:
+            expr_trees = expr_or_set.get_trees(outputs)
+        self.funcs = vector_funcs() if vectorized else code_funcs()
+        # per node: [calls, total time, expr_tree, child node indexes, profiled func]
+        self.nodes = []
+        self.roots = []
+        self.__funcs = []
+        for expr_tree in expr_trees:
+            self.roots.append(len(self.nodes))
+            self.__funcs.append(self.__instrument(expr_tree))
+
+    def eval(self, vs):
+        "Profiled Expr.eval"
+        return self.__funcs[0](vs)
+
     def eval_all(self, vs):
-        return [expr.eval(vs) for expr in self.__exprs]
+        "Profiled ExprSet.eval_all"
+        return [func(vs) for func in self.__funcs]
+
+    def reset(self):
+        for node in self.nodes:
+            node[0] = 0
+            node[1] = 0.0
+
+    def __instrument(self, expr_tree):
+        node = [0, 0.0, expr_tree, []]
+        self.nodes.append(node)
+        node_type = expr_tree[0]
+
+        if node_type in ["assign", "func", "binop"]:
+            for child_tree in expr_tree[2:]:
+                node[3].append(len(self.nodes))
+                self.__instrument(child_tree)
+            children = [self.nodes[i] for i in node[3]]
+
+        if node_type == "assign":
+            name = expr_tree[1]
+            expr_func = children[0][4]
+            def func(vs):
+                start = perf_counter()
+                answer = expr_func(vs)
+                vs[name] = answer
+                node[0] += 1
+                node[1] += perf_counter() - start
+                return answer
+        elif node_type == "func" and expr_tree[1] in self.funcs:
+            math_func = self.funcs[expr_tree[1]]
+            arg_funcs = [child[4] for child in children]
+            def func(vs):
+                start = perf_counter()
+                answer = math_func(*[arg_func(vs) for arg_func in arg_funcs])
+                node[0] += 1
+                node[1] += perf_counter() - start
+                return answer
+        elif node_type == "binop":
+            op_func = BIN_OPS[expr_tree[1]][1]
+            expr1_func = children[0][4]
+            expr2_func = children[1][4]
+            def func(vs):
+                start = perf_counter()
+                answer = op_func(expr1_func(vs), expr2_func(vs))
+                node[0] += 1
+                node[1] += perf_counter() - start
+                return answer
+        else:
+            leaf_func = tree_to_func(expr_tree)
+            def func(vs):
+                start = perf_counter()
+                answer = leaf_func(vs)
+                node[0] += 1
+                node[1] += perf_counter() - start
+                return answer
+        node.append(func)
+        return func
+
+    def report(self, top=10):
+        """
+        Text report of the time in each assignment, then the top subtrees by their own
+        time, excluding the nodes below them
+        """
+        lines = ["%8s %10s %10s  %s" % ("calls", "total ms", "per call us", "assignment")]
+        for i in self.roots:
+            calls, total, expr_tree = self.nodes[i][:3]
+            lines.append("%8d %10.3f %10.3f  %s" % (
+                    calls, total * 1e3, total * 1e6 / calls if calls else 0.0,
+                    tree_to_text(expr_tree)))
+
+        def self_time(node):
+            return node[1] - sum(self.nodes[i][1] for i in node[3])
+        hot = sorted(
+                (node for node in self.nodes if node[3]),
+                key=self_time, reverse=True)[:top]
+        lines.append("")
+        lines.append("%8s %10s %10s  %s" % ("calls", "self ms", "total ms", "subtree"))
+        for node in hot:
+            lines.append("%8d %10.3f %10.3f  %s" % (
+                    node[0], self_time(node) * 1e3, node[1] * 1e3, tree_to_text(node[2])))
+        return "\n".join(lines)
 
 ########################################
 # Binary Operators
@@ -103,9 +493,109 @@ BIN_OPS = {
 highestPrecedenceOp = 2
 lowestPrecedenceOp = 3
 
-def addBinaryOp(symbol, precedence, func):
+# the ops evaluated over interval.Intervals, the default ones are python operators
+INTERVAL_BIN_OPS = {}
+
+# changed by each addBinaryOp and addFunction, as the Exprs they parse and fold may change
+ops_version = 0
+
+def addBinaryOp(symbol, precedence, func, interval_func=None):
+    """
+    :param interval_func: func over interval.Intervals, bounding func for every value
+        in its operands, for ExprSet.eval_interval
+    """
+    global ops_version
+
     LEX_TOKENS_EXT.append((re.compile(r"\s*(" + "".join(("[%s]"%s for s in symbol)) + ")"), "bop"))
     BIN_OPS[symbol] = (precedence, func)
+    if interval_func:
+        INTERVAL_BIN_OPS[symbol] = interval_func
+    else:
+        INTERVAL_BIN_OPS.pop(symbol, None)
+    ops_version += 1
+
+def code_signature(code):
+    "What identifies a code object between runs, including the code of nested functions"
+    return (code.co_code, code.co_names, code.co_varnames, tuple(
+        code_signature(const) if type(const) is type(code) else repr(const)
+        for const in code.co_consts))
+
+def impl_signature(func):
+    """
+    What identifies func between runs, its code with its constants, defaults and the
+    values it closes over, or the name of a builtin
+    """
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        cells = tuple(repr(cell.cell_contents) for cell in func.__closure__ or ())
+        return (code_signature(code), repr(func.__defaults__), cells)
+    return (getattr(func, "__module__", None), getattr(func, "__qualname__", repr(func)))
+
+def ops_signature():
+    """
+    Text describing the grammar, the binary op functions and the functions, the same
+    between runs while they are the same
+    """
+    return repr((
+        [t1.pattern for t1, t2 in LEX_TOKENS_EXT],
+        sorted(
+            (symbol, precedence, impl_signature(func))
+            for symbol, (precedence, func) in BIN_OPS.items()),
+        sorted(
+            (name, func.arity, func.pure, impl_signature(func.scalar_impl))
+            for name, func in FUNCS.items()),
+        ))
+
+########################################
+# Functions
+########################################
+
+class Function(object):
+    "A function expressions can call, see addFunction()"
+
+    def __init__(self, arity, scalar_impl, vector_impl, pure, interval_impl, derivative):
+        self.arity = arity
+        self.scalar_impl = scalar_impl
+        self.vector_impl = vector_impl
+        self.pure = pure
+        self.interval_impl = interval_impl
+        self.derivative = derivative
+
+# the Functions by name
+FUNCS = {}
+
+def addFunction(name, arity, scalar_impl, vector_impl=None, pure=True,
+        interval_impl=None, derivative=None):
+    """
+    Add a function expressions can call as name(arg, ...), or replace one
+
+    :param arity: the number of arguments
+    :param scalar_impl: the function over numbers
+    :param vector_impl: the function over numpy arrays, or the name of a numpy function,
+        for ExprSet.eval_vectorized; if None, scalar_impl is called for each element
+    :param pure: if the result depends only on the arguments, so calls are folded when
+        the arguments are constants, evaluated once when repeated, and staged
+    :param interval_impl: the function over interval.Intervals bounding scalar_impl for
+        every value in its arguments, or the name of one in interval,
+        for ExprSet.eval_interval
+    :param derivative: function of the argument trees, returning the trees of the partial
+        derivatives by each argument, for ExprSet.diff
+    """
+    global ops_version
+
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) or name == "pi":
+        raise Exception("bad function name: %s"%(name))
+    FUNCS[name] = Function(arity, scalar_impl, vector_impl, pure, interval_impl, derivative)
+    ops_version += 1
+
+def is_pure_call(expr_tree):
+    "Test if the func node expr_tree calls a pure function"
+    return expr_tree[1] in FUNCS and FUNCS[expr_tree[1]].pure
+
+addFunction("sin", 1, math.sin, "sin", interval_impl="sin",
+        derivative=lambda x: [("func", "cos", x)])
+addFunction("cos", 1, math.cos, "cos", interval_impl="cos",
+        derivative=lambda x: [diff_mul(("lit_int", -1), ("func", "sin", x))])
 
 ########################################
 # Lexer
@@ -126,43 +616,64 @@ LEX_TOKENS = [(re.compile(r"\s*(" + t1 + ")"), t2) for t1, t2 in LEX_TOKENS]
 
 LEX_TOKENS_EXT = []
 
+# the LEX_TOKENS_EXT and LEX_TOKENS tried in order, as one regex, see lex_regex()
+lex_cache = (None, None, None)
+
+def lex_regex():
+    """
+    One regex trying all the token regexes in order, and the token types by the index
+    of their group; rebuilt when LEX_TOKENS_EXT changes
+    """
+    global lex_cache
+
+    lex_t = LEX_TOKENS_EXT + LEX_TOKENS
+    if lex_cache[0] != lex_t:
+        patterns = []
+        group_types = {}
+        groups = 0
+        for t1, t2 in lex_t:
+            # each token regex is \s*(token), its group 1 is the token
+            patterns.append("(" + t1.pattern + ")")
+            group_types[groups + 1] = (t2, groups + 2)
+            groups += 1 + t1.groups
+        lex_cache = (lex_t, re.compile("|".join(patterns)), group_types)
+    return lex_cache[1], lex_cache[2]
+
 def lex(expr_text):
-    LEX_T = LEX_TOKENS_EXT + LEX_TOKENS
+    regex, group_types = lex_regex()
+    match = regex.match
     tokens = []
     position = 0
-    while expr_text:
-        for t1, t2 in LEX_T:
-            m = t1.match(expr_text)
-            if m:
-                tokens.append((t2, m.group(1)))
-                position += m.end()
-                expr_text = expr_text[m.end():]
-                break
-        else:
-            raise LexException("can't tokenize at " + expr_text)
+    end = len(expr_text)
+    while position < end:
+        m = match(expr_text, position)
+        if not m:
+            raise LexException("can't tokenize at " + expr_text[position:])
+        tok_type, group = group_types[m.lastindex]
+        tokens.append((tok_type, m.group(group)))
+        position = m.end()
     return tokens
 
 def lex_file(file_name):
     with open(file_name) as open_file:
-        return [
-            token
-            for line in open_file
-            for token in lex(line.rstrip())]
+        return lex_lines(open_file)
+
+def lex_lines(lines):
+    return [
+        token
+        for line in lines
+        for token in lex(line.rstrip())]
 
 ########################################
 # Parser
 ########################################
 
-FUNC_NAMES = set()
-FUNC_NAMES.add("sin")
-FUNC_NAMES.add("cos")
-
 def parse(tokens):
     """
     an expr_tree node has the following forms:
         ("assign", name, expr_tree)
         ("var", name)
-        ("func", name, expr_tree)
+        ("func", name, expr_tree, ...)
         ("binop", op, expr1_tree, expr2_tree)
         ("lit_int", int)
         ("lit_float", float)
@@ -170,84 +681,136 @@ def parse(tokens):
 
     :return: (remaning tokens, expr_tree)
     """
-    if tokens:
-        tokens, expr1_tree = parse_leaf(tokens)
-        return parse_expr_binops(tokens, expr1_tree, lowestPrecedenceOp)
-    return (None, None)
+    parser = Parser(tokens)
+    expr_tree = parser.parse()
+    return (parser.remaining(), expr_tree)
+
+class Parser(object):
+    """
+    Recursive descent parser, advancing an index over the tokens rather than slicing them
+    """
 
-def parse_expr_binops(tokens, expr1_tree, precedence):
-    "Expect binary ops (+, -)"
+    def __init__(self, tokens, pos=0):
+        self.tokens = tokens
+        self.pos = pos
+        self.at_end = False
 
-    if precedence == highestPrecedenceOp:
-        parse_expr_next = parse_expr1
-    else:
-        parse_expr_next = parse_expr_binops
-    tokens, expr1_tree = parse_expr_next(tokens, expr1_tree, precedence-1)
-    if not tokens:
-        return (tokens, expr1_tree)
-
-    top_token = tokens[0]
-    tok_type = top_token[0]
-    tok_value = top_token[1]
-
-    if tok_type == "bop":
-        if BIN_OPS[tok_value][0] == precedence:
-            tokens, expr2_tree = parse_leaf(tokens[1:])
-            tokens, expr2_tree = parse_expr_next(tokens, expr2_tree, precedence-1)
-            return parse_expr_next(tokens, ("binop", tok_value, expr1_tree, expr2_tree), precedence)
-    return (tokens, expr1_tree)
-
-def parse_expr1(tokens, expr1_tree, precedence):
-    "Expect binary ops (=)"
-
-    if not tokens:
-        return (tokens, expr1_tree)
-
-    top_token = tokens[0]
-    tok_type = top_token[0]
-
-    if tok_type == "eq":
-        if expr1_tree[0] != "var":
-            raise ParseException("LHS must be a variable name " + repr(tokens))
-        tokens, expr2_tree = parse(tokens[1:])
-        name = expr1_tree[1]
-        return parse_expr1(tokens, ["assign", name, expr2_tree], 0)
-    return (tokens, expr1_tree)
-
-def parse_leaf(tokens):
-    "Expect literals, variables, function calls, and parenthases"
-    top_token = tokens[0]
-    tok_type = top_token[0]
-    tok_value = top_token[1]
-
-    if tok_type == "lit_int":
-        return (tokens[1:], top_token)
-    elif tok_type == "lit_float":
-        return (tokens[1:], top_token)
-    elif tok_type == "name":
-        return parse_name(tokens[1:], tok_value)
-    elif tok_type == "open":
-        tokens, expr_tree = parse(tokens[1:])
-        if tokens and tokens[0][0] == "close":
-            return (tokens[1:], expr_tree)
+    def remaining(self):
+        "The unparsed tokens, None if the last parse() found none"
+        if self.at_end:
+            return None
+        return self.tokens[self.pos:]
+
+    def peek(self):
+        "The next token, None if all are parsed"
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+    def parse(self):
+        ":return: expr_tree, None if there are no tokens left"
+        self.at_end = self.pos >= len(self.tokens)
+        if self.at_end:
+            return None
+        expr1_tree = self.parse_leaf()
+        return self.parse_expr_binops(expr1_tree, lowestPrecedenceOp)
+
+    def parse_expr_binops(self, expr1_tree, precedence):
+        "Expect binary ops (+, -)"
+
+        if precedence == highestPrecedenceOp:
+            parse_expr_next = self.parse_expr1
         else:
-            raise ParseException("missing closing paren at " + repr(tokens))
-    raise ParseException("parse error at " + repr(tokens))
-
-def parse_name(tokens, name):
-    if tokens:
-        tok_type = tokens[0][0]
-        if tok_type == "open":
-            tokens, expr_tree = parse(tokens[1:])
-            if tokens and tokens[0][0] == "close":
-                if name not in FUNC_NAMES:
-                    raise Excpetion("uknown function " + name)
-                return (tokens[1:], ("func", name, expr_tree))
-            else:
-                raise ParseException("missing closing paren at " + repr(tokens))
-    if name == "pi":
-        return (tokens, ("lit_float", name))
-    return (tokens, ("var", name))
+            parse_expr_next = self.parse_expr_binops
+        while True:
+            expr1_tree = parse_expr_next(expr1_tree, precedence-1)
+
+            top_token = self.peek()
+            if not (top_token and top_token[0] == "bop"
+                    and BIN_OPS[top_token[1]][0] == precedence):
+                return expr1_tree
+            self.pos += 1
+            expr2_tree = self.parse_leaf()
+            expr2_tree = parse_expr_next(expr2_tree, precedence-1)
+            expr1_tree = ("binop", top_token[1], expr1_tree, expr2_tree)
+            if parse_expr_next == self.parse_expr1:
+                return self.parse_expr1(expr1_tree, precedence)
+
+    def parse_expr1(self, expr1_tree, precedence):
+        "Expect binary ops (=)"
+
+        while True:
+            top_token = self.peek()
+            if not top_token or top_token[0] != "eq":
+                return expr1_tree
+            if expr1_tree[0] != "var":
+                raise ParseException("LHS must be a variable name " + repr(self.tokens[self.pos:]))
+            self.pos += 1
+            expr2_tree = self.parse()
+            expr1_tree = ["assign", expr1_tree[1], expr2_tree]
+
+    def parse_paren(self):
+        "Expect an expression, then a closing paren"
+        expr_tree = self.parse()
+        top_token = self.peek()
+        if expr_tree is not None and top_token and top_token[0] == "close":
+            return expr_tree
+        raise ParseException("missing closing paren at " + repr(self.remaining()))
+
+    def parse_args(self):
+        "Expect expressions separated by commas, then a closing paren"
+        top_token = self.peek()
+        if top_token and top_token[0] == "close":
+            return []
+        arg_trees = [self.parse()]
+        while arg_trees[-1] is not None:
+            top_token = self.peek()
+            if not top_token or top_token[0] != "delim":
+                break
+            self.pos += 1
+            arg_trees.append(self.parse())
+        top_token = self.peek()
+        if arg_trees[-1] is not None and top_token and top_token[0] == "close":
+            return arg_trees
+        raise ParseException("missing closing paren at " + repr(self.remaining()))
+
+    def parse_leaf(self):
+        "Expect literals, variables, function calls, and parenthases"
+        top_token = self.peek()
+        if not top_token:
+            raise ParseException("unexpected end of expression")
+        tok_type = top_token[0]
+        tok_value = top_token[1]
+
+        if tok_type == "lit_int":
+            self.pos += 1
+            return top_token
+        elif tok_type == "lit_float":
+            self.pos += 1
+            return top_token
+        elif tok_type == "name":
+            self.pos += 1
+            return self.parse_name(tok_value)
+        elif tok_type == "open":
+            self.pos += 1
+            expr_tree = self.parse_paren()
+            self.pos += 1
+            return expr_tree
+        raise ParseException("parse error at " + repr(self.tokens[self.pos:]))
+
+    def parse_name(self, name):
+        top_token = self.peek()
+        if top_token and top_token[0] == "open":
+            self.pos += 1
+            arg_trees = self.parse_args()
+            if name not in FUNCS:
+                raise ParseException("unknown function " + name)
+            if len(arg_trees) != FUNCS[name].arity:
+                raise ParseException("%s takes %d arguments" % (name, FUNCS[name].arity))
+            self.pos += 1
+            return ("func", name) + tuple(arg_trees)
+        if name == "pi":
+            return ("lit_float", name)
+        return ("var", name)
 
 ########################################
 # Parse tree utilities
@@ -267,12 +830,12 @@ def tree_to_func(expr_tree):
     if node_type == "var":
         return lambda vs: vs[expr_tree[1]]
     if node_type == "func":
-        node_type, name, expr_tree = expr_tree
-        expr_func = tree_to_func(expr_tree)
-        if name == "sin":
-            return lambda vs: math.sin(expr_func(vs))
-        elif name == "cos":
-            return lambda vs: math.cos(expr_func(vs))
+        math_func = FUNCS[expr_tree[1]].scalar_impl
+        arg_funcs = [tree_to_func(arg_tree) for arg_tree in expr_tree[2:]]
+        if len(arg_funcs) == 1:
+            expr_func = arg_funcs[0]
+            return lambda vs: math_func(expr_func(vs))
+        return lambda vs: math_func(*[arg_func(vs) for arg_func in arg_funcs])
     if node_type == "binop":
         node_type, name, expr1_tree, expr2_tree = expr_tree
         expr1_func = tree_to_func(expr1_tree)
@@ -293,6 +856,283 @@ def tree_to_func(expr_tree):
         return lambda vs: expr_tree[1]
     raise Exception("bad parse tree type: %s"%(node_type))
 
+########################################
+# Code generation
+########################################
+
+# binary ops that compile to python operators, while they still have their default function
+INLINE_BIN_OPS = {
+    '*': (BIN_OPS['*'][1], ast.Mult),
+    '/': (BIN_OPS['/'][1], ast.Div),
+    '+': (BIN_OPS['+'][1], ast.Add),
+    '-': (BIN_OPS['-'][1], ast.Sub),
+}
+
+def code_funcs():
+    "Functions for code evaluating over numbers"
+    return {name: func.scalar_impl for name, func in FUNCS.items()}
+
+def interval_funcs():
+    """
+    Functions for code evaluating over interval.Intervals, see ExprSet.eval_interval,
+    leaving out those without an interval_impl
+    """
+    import interval
+    funcs = {}
+    for name, func in FUNCS.items():
+        impl = func.interval_impl
+        if type(impl) is str:
+            impl = getattr(interval, impl)
+        if impl is not None:
+            funcs[name] = impl
+    return funcs
+
+def vector_funcs():
+    "Functions for code evaluating over numpy arrays, numpy is only imported when needed"
+    import numpy
+    funcs = {}
+    for name, func in FUNCS.items():
+        impl = func.vector_impl
+        if type(impl) is str:
+            impl = getattr(numpy, impl)
+        elif impl is None and func.arity:
+            # with otypes, vectorize doesn't call the function an extra time to find them
+            impl = numpy.vectorize(func.scalar_impl, otypes=[float])
+        elif impl is None:
+            impl = func.scalar_impl
+        funcs[name] = impl
+    return funcs
+
+class CodeGen(object):
+    """
+    Build one python function from a list of expr_trees
+
+    Variables are kept in locals, read from vs the first time they are used and written
+    back to vs after each assigning expression, and binary ops are inlined.
+    funcs maps function names to their implementation, code_funcs() by default, or
+    vector_funcs() or interval_funcs().
+    Variables in closure_names are not in vs, they are arguments to a function making
+    the function of vs; when closure_names is given, the maker is returned even if it
+    has no arguments.  op_funcs replaces the BIN_OPS functions of the ops that aren't
+    python operators, for code over other types, such as INTERVAL_BIN_OPS.
+
+    Identical subtrees are evaluated once: count() value numbers the subtrees of all the
+    expr_trees, keying variables by the value last assigned to them, and subtrees seen
+    more than once are kept in a local the first time they are evaluated.  Value
+    numbers are small ints, each for a node's type and op and the value numbers of its
+    children, so they stay small however deep the trees and chains of assignments.
+    """
+
+    def __init__(self, funcs=None, closure_names=None, op_funcs=None):
+        self.funcs = code_funcs() if funcs is None else funcs
+        self.op_funcs = op_funcs
+        self.closure_names = None if closure_names is None else list(closure_names)
+        self.namespace = {}
+        self.bound = set(closure_names or ())
+        self.assigned = []
+        self.counts = {}
+        self.temps = {}
+        self.var_keys = {}
+        self.unshared = 0
+        self.value_numbers = {}
+
+    def add_global(self, prefix, value):
+        name = "%s%d" % (prefix, len(self.namespace))
+        self.namespace[name] = value
+        return ast.Name(name, ast.Load())
+
+    def value_number(self, key):
+        "The small int numbering key, the same for equal keys"
+        return self.value_numbers.setdefault(key, len(self.value_numbers))
+
+    def key(self, expr_tree, child_keys):
+        """
+        The value number of expr_tree, None for subtrees with assignments or calls of
+        functions which aren't pure, which are never shared
+        """
+        node_type = expr_tree[0]
+
+        if node_type == "var":
+            if expr_tree[1] in self.var_keys:
+                return self.var_keys[expr_tree[1]]
+            return self.value_number(expr_tree)
+        if node_type == "assign":
+            key = child_keys[0]
+            if key is None:
+                self.unshared += 1
+                key = self.value_number(("assign", expr_tree[1], self.unshared))
+            self.var_keys[expr_tree[1]] = key
+            return None
+        if None in child_keys:
+            return None
+        if node_type == "func" and not is_pure_call(expr_tree):
+            return None
+        if is_const_node(expr_tree):
+            value = expr_tree[1]
+            if type(value) not in [int, float, str]:
+                return self.value_number((node_type, id(value)))
+            return self.value_number((node_type, repr(value)))
+        return self.value_number((node_type, expr_tree[1]) + tuple(child_keys))
+
+    def count(self, expr_tree):
+        "Count the subtrees of expr_tree by value number, returning its value number"
+        child_keys = []
+        if expr_tree[0] in ["assign", "func", "binop"]:
+            # a loop rather than a comprehension, which would double the recursion depth
+            for child in expr_tree[2:]:
+                child_keys.append(self.count(child))
+        key = self.key(expr_tree, child_keys)
+        if expr_tree[0] in ["func", "binop"] and key is not None:
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return key
+
+    def node(self, expr_tree):
+        "The ast node for expr_tree, and its value number"
+        node_type = expr_tree[0]
+
+        if node_type == "assign":
+            value, key = self.node(expr_tree[2])
+            name = expr_tree[1]
+            self.bound.add(name)
+            if name not in self.assigned:
+                self.assigned.append(name)
+            return (ast.NamedExpr(ast.Name("v_" + name, ast.Store()), value),
+                    self.key(expr_tree, [key]))
+        if node_type == "var":
+            name = expr_tree[1]
+            key = self.key(expr_tree, [])
+            if name in self.bound:
+                return (ast.Name("v_" + name, ast.Load()), key)
+            self.bound.add(name)
+            return (ast.NamedExpr(
+                    ast.Name("v_" + name, ast.Store()),
+                    ast.Subscript(ast.Name("vs", ast.Load()), ast.Constant(name), ast.Load())),
+                    key)
+        if node_type in ["lit_int", "lit_float", "lit_other"]:
+            value = tree_to_func(expr_tree)(None)
+            if type(value) in [int, float]:
+                return (ast.Constant(value), self.key(expr_tree, []))
+            return (self.add_global("c", value), self.key(expr_tree, []))
+
+        if node_type == "func":
+            if expr_tree[1] not in self.funcs:
+                raise EvalException("no implementation of function " + expr_tree[1])
+            args = []
+            child_keys = []
+            for arg_tree in expr_tree[2:]:
+                arg, arg_key = self.node(arg_tree)
+                args.append(arg)
+                child_keys.append(arg_key)
+        elif node_type == "binop":
+            left, left_key = self.node(expr_tree[2])
+            right, right_key = self.node(expr_tree[3])
+            child_keys = [left_key, right_key]
+        else:
+            raise Exception("bad parse tree type: %s"%(node_type))
+        key = self.key(expr_tree, child_keys)
+        if key in self.temps:
+            # the children were evaluated for the temp, and have no assignments
+            return (ast.Name(self.temps[key], ast.Load()), key)
+
+        if node_type == "func":
+            func = self.add_global("f", self.funcs[expr_tree[1]])
+            value = ast.Call(func, args, [])
+        else:
+            name = expr_tree[1]
+            func = BIN_OPS[name][1]
+            if name in INLINE_BIN_OPS and INLINE_BIN_OPS[name][0] is func:
+                value = ast.BinOp(left, INLINE_BIN_OPS[name][1](), right)
+            else:
+                if self.op_funcs is not None:
+                    if name not in self.op_funcs:
+                        raise EvalException("no implementation of op " + name)
+                    func = self.op_funcs[name]
+                value = ast.Call(self.add_global("op", func), [left, right], [])
+        if self.counts.get(key, 0) > 1:
+            self.temps[key] = "t%d" % len(self.temps)
+            value = ast.NamedExpr(ast.Name(self.temps[key], ast.Store()), value)
+        return (value, key)
+
+    def statements(self, expr_tree, result_name):
+        "Statements computing expr_tree into result_name, then storing its assignments in vs"
+        self.assigned = []
+        body = [ast.Assign([ast.Name(result_name, ast.Store())], self.node(expr_tree)[0])]
+        for name in self.assigned:
+            body.append(ast.Assign(
+                [ast.Subscript(ast.Name("vs", ast.Load()), ast.Constant(name), ast.Store())],
+                ast.Name("v_" + name, ast.Load())))
+        return body
+
+    def function(self, body, result):
+        module = ast.parse("def expr_func(vs):\n    pass\n")
+        module.body[0].body = body + [ast.Return(result)]
+        name = "expr_func"
+        if self.closure_names is not None:
+            func_def = module.body[0]
+            module = ast.parse("def make_expr_func(%s):\n    pass\n"
+                    % ", ".join("v_" + closure_name for closure_name in self.closure_names))
+            module.body[0].body = [func_def, ast.Return(ast.Name(name, ast.Load()))]
+            name = "make_expr_func"
+        ast.fix_missing_locations(module)
+        namespace = dict(self.namespace)
+        exec(compile(module, "<expr>", "exec"), namespace)
+        return namespace[name]
+
+    def compile(self, expr_trees, results):
+        "Count and then compile expr_trees, returning results from their values"
+        for expr_tree in expr_trees:
+            self.count(expr_tree)
+        self.var_keys = {}
+        self.unshared = 0
+        body = []
+        for i, expr_tree in enumerate(expr_trees):
+            body += self.statements(expr_tree, "r%d" % i)
+        return self.function(body, results)
+
+def tree_to_code(expr_tree):
+    "Compile expr_tree to a python function of vs, returning the value of the expression"
+    return CodeGen().compile([expr_tree], ast.Name("r0", ast.Load()))
+
+def trees_to_code(expr_trees, funcs=None, closure_names=None, op_funcs=None):
+    """
+    Compile expr_trees to a python function of vs, returning the list of their values
+    with closure_names, even none, return a function of their values which makes that
+    function
+    """
+    results = ast.List([ast.Name("r%d" % i, ast.Load()) for i in range(len(expr_trees))],
+            ast.Load())
+    return CodeGen(funcs, closure_names, op_funcs).compile(expr_trees, results)
+
+def tree_to_text(expr_tree, precedence=None):
+    """
+    Source text for expr_tree, with the parens the parser needs
+
+    :param precedence: precedence of the binary op expr_tree is an operand of, its right
+        operand if negative
+    """
+    node_type = expr_tree[0]
+
+    if node_type == "assign":
+        text = "%s = %s" % (expr_tree[1], tree_to_text(expr_tree[2]))
+        return text if precedence is None else "(%s)" % text
+    if node_type == "var":
+        return expr_tree[1]
+    if node_type == "func":
+        return "%s(%s)" % (expr_tree[1],
+                ", ".join(tree_to_text(arg_tree) for arg_tree in expr_tree[2:]))
+    if node_type == "binop":
+        op = expr_tree[1]
+        op_precedence = BIN_OPS[op][0]
+        text = "%s %s %s" % (
+                tree_to_text(expr_tree[2], op_precedence),
+                op,
+                tree_to_text(expr_tree[3], -op_precedence))
+        if precedence is not None and (op_precedence > abs(precedence)
+                or (op_precedence == -precedence)):
+            return "(%s)" % text
+        return text
+    return str(expr_tree[1])
+
 def is_const_node(expr_tree):
     return expr_tree[0].startswith("lit_")
 
@@ -301,10 +1141,12 @@ def fold_constants(expr_tree):
     node_type = expr_tree[0]
 
     is_const = False
-    if node_type in ["assign", "func"]:
-        expr1_tree = fold_constants(expr_tree[2])
-        expr_tree = (node_type, expr_tree[1], expr1_tree)
-        is_const = node_type == "func" and is_const_node(expr1_tree)
+    if node_type == "assign":
+        expr_tree = (node_type, expr_tree[1], fold_constants(expr_tree[2]))
+    elif node_type == "func":
+        arg_trees = tuple(fold_constants(arg_tree) for arg_tree in expr_tree[2:])
+        expr_tree = (node_type, expr_tree[1]) + arg_trees
+        is_const = is_pure_call(expr_tree) and all(is_const_node(arg_tree) for arg_tree in arg_trees)
     elif node_type == "binop":
         expr1_tree = fold_constants(expr_tree[2])
         expr2_tree = fold_constants(expr_tree[3])
@@ -320,6 +1162,162 @@ def fold_constants(expr_tree):
             return ("lit_other", const_value)
     return expr_tree
 
+def diff_name(name, var):
+    "Name of the variable holding the derivative of name by var"
+    return "d%s_d%s" % (name, var)
+
+def is_number_node(expr_tree, value):
+    return expr_tree[0] in ["lit_int", "lit_float"] and tree_to_func(expr_tree)(None) == value
+
+def diff_add(op, expr1_tree, expr2_tree):
+    if is_number_node(expr2_tree, 0):
+        return expr1_tree
+    if is_number_node(expr1_tree, 0):
+        return expr2_tree if op == "+" else diff_mul(("lit_int", -1), expr2_tree)
+    return ("binop", op, expr1_tree, expr2_tree)
+
+def diff_mul(expr1_tree, expr2_tree):
+    if is_number_node(expr1_tree, 0) or is_number_node(expr2_tree, 0):
+        return ("lit_int", 0)
+    if is_number_node(expr1_tree, 1):
+        return expr2_tree
+    if is_number_node(expr2_tree, 1):
+        return expr1_tree
+    return ("binop", "*", expr1_tree, expr2_tree)
+
+def diff_tree(expr_tree, var, d_names):
+    """
+    The derivative of expr_tree by the variable var, dropping the terms which are zero
+
+    Assignments become assignments to the derivative of the variable, so evaluate it
+    after expr_tree, which sets the variables it reads.
+
+    :param d_names: the variables with derivatives assigned so far, by their name,
+        other variables than var are constants; updated with the assignments of expr_tree
+    """
+    node_type = expr_tree[0]
+
+    if node_type == "assign":
+        d_tree = diff_tree(expr_tree[2], var, d_names)
+        d_names[expr_tree[1]] = diff_name(expr_tree[1], var)
+        return (node_type, d_names[expr_tree[1]], d_tree)
+    if node_type == "var":
+        if expr_tree[1] == var:
+            return ("lit_int", 1)
+        if expr_tree[1] in d_names:
+            return ("var", d_names[expr_tree[1]])
+        return ("lit_int", 0)
+    if node_type == "func":
+        arg_trees = expr_tree[2:]
+        d_trees = [diff_tree(arg_tree, var, d_names) for arg_tree in arg_trees]
+        func = FUNCS.get(expr_tree[1])
+        if func is None or func.derivative is None:
+            raise DiffException("can't differentiate function " + expr_tree[1])
+        d_tree = ("lit_int", 0)
+        for partial_tree, d_arg_tree in zip(func.derivative(*arg_trees), d_trees):
+            d_tree = diff_add("+", d_tree, diff_mul(partial_tree, d_arg_tree))
+        return d_tree
+    if node_type == "binop":
+        node_type, op, expr1_tree, expr2_tree = expr_tree
+        d1_tree = diff_tree(expr1_tree, var, d_names)
+        d2_tree = diff_tree(expr2_tree, var, d_names)
+        if op in ["+", "-"]:
+            return diff_add(op, d1_tree, d2_tree)
+        if op == "*":
+            return diff_add("+", diff_mul(d1_tree, expr2_tree), diff_mul(expr1_tree, d2_tree))
+        if op == "/":
+            if is_number_node(d2_tree, 0):
+                return ("binop", "/", d1_tree, expr2_tree)
+            return ("binop", "/",
+                    diff_add("-", diff_mul(d1_tree, expr2_tree), diff_mul(expr1_tree, d2_tree)),
+                    ("binop", "*", expr2_tree, expr2_tree))
+        raise DiffException("can't differentiate op " + op)
+    return ("lit_int", 0)
+
+def diff_trees(expr_trees, var, order=1):
+    """
+    expr_trees, each followed by its derivatives by var up to order, see diff_tree()
+    """
+    d_names = {}
+    result = []
+    for expr_tree in expr_trees:
+        result.append(expr_tree)
+        for i in range(order):
+            expr_tree = fold_constants(diff_tree(expr_tree, var, d_names))
+            result.append(expr_tree)
+    return result
+
+class Stager(object):
+    """
+    Binding time analysis, splitting expr_trees into stage one, the subtrees depending
+    only on the slow variables, and the residual trees which use their values.
+
+    Subtrees of stage one are hoisted into stage_trees, as assignments to __stage<n>,
+    which the residual trees read as variables.  Variables assigned a stage one
+    value are read from their stage name, so stage one never assigns the real names.
+    """
+
+    def __init__(self, slow_names):
+        self.slow_names = set(slow_names)
+        self.stage_trees = []
+        self.static_names = {}
+        self.dynamic_names = set()
+
+    def hoist(self, expr_tree):
+        name = "__stage%d" % len(self.stage_trees)
+        self.stage_trees.append(("assign", name, expr_tree))
+        return ("var", name)
+
+    def residual(self, is_static, expr_tree):
+        "The residual tree for the result of split()"
+        if is_static and not is_const_node(expr_tree):
+            return self.hoist(expr_tree)
+        return expr_tree
+
+    def split(self, expr_tree):
+        """
+        Split expr_tree, in evaluation order
+
+        :return: (is_static, tree) where tree is a stage one tree if is_static,
+            and a residual tree otherwise
+        """
+        node_type = expr_tree[0]
+
+        if node_type == "var":
+            name = expr_tree[1]
+            if name in self.static_names:
+                return (True, self.static_names[name])
+            return (name in self.slow_names and name not in self.dynamic_names, expr_tree)
+        if node_type == "assign":
+            name = expr_tree[1]
+            is_static, expr1_tree = self.split(expr_tree[2])
+            expr1_tree = self.residual(is_static, expr1_tree)
+            if is_static:
+                self.static_names[name] = expr1_tree
+                self.dynamic_names.discard(name)
+            else:
+                self.static_names.pop(name, None)
+                self.dynamic_names.add(name)
+            # the assignment itself stays in the residual, so vs gets the variable
+            return (False, (node_type, name, expr1_tree))
+        if node_type == "func":
+            splits = [self.split(arg_tree) for arg_tree in expr_tree[2:]]
+            # functions which aren't pure are called each time, not once per stage
+            if is_pure_call(expr_tree) and all(is_static for is_static, arg_tree in splits):
+                return (True, (node_type, expr_tree[1])
+                        + tuple(arg_tree for is_static, arg_tree in splits))
+            return (False, (node_type, expr_tree[1])
+                    + tuple(self.residual(is_static, arg_tree) for is_static, arg_tree in splits))
+        if node_type == "binop":
+            is_static1, expr1_tree = self.split(expr_tree[2])
+            is_static2, expr2_tree = self.split(expr_tree[3])
+            if is_static1 and is_static2:
+                return (True, (node_type, expr_tree[1], expr1_tree, expr2_tree))
+            return (False, (node_type, expr_tree[1],
+                    self.residual(is_static1, expr1_tree),
+                    self.residual(is_static2, expr2_tree)))
+        return (True, expr_tree)
+
 def get_sets(var_names, assign_names, expr_tree):
     node_type = expr_tree[0]
 
@@ -327,13 +1325,33 @@ def get_sets(var_names, assign_names, expr_tree):
         var_names.add(expr_tree[1])
     elif node_type == "assign":
         assign_names.add(expr_tree[1])
-        var_names.add(expr_tree[2])
-    elif node_type == "func":
         get_sets(var_names, assign_names, expr_tree[2])
+    elif node_type == "func":
+        for arg_tree in expr_tree[2:]:
+            get_sets(var_names, assign_names, arg_tree)
     elif node_type == "binop":
         get_sets(var_names, assign_names, expr_tree[2])
         get_sets(var_names, assign_names, expr_tree[3])
 
+def live_trees(expr_trees, outputs):
+    """
+    Drop the expr_trees the final values of the variables in outputs don't depend on
+
+    An expr_tree is kept if it assigns a variable which is live after it, working back
+    from outputs; the variables it reads are then live before it.
+    """
+    live_names = set(outputs)
+    kept = []
+    for expr_tree in reversed(expr_trees):
+        var_names = set()
+        assign_names = set()
+        get_sets(var_names, assign_names, expr_tree)
+        if live_names & assign_names:
+            kept.append(expr_tree)
+            live_names = (live_names - assign_names) | var_names
+    kept.reverse()
+    return kept
+
 ########################################
 # Testing
 ########################################
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+"""
+Batch evaluation of an ExprSet over many bindings of its parameters, spread over a
+process pool, with the results streamed in order to a callback, a CSV file or a
+binary columnar file.
+
+usage: expr_batch.py [-processes=N] [-vectorized] [-csv=FILE] [-columns=FILE]
+                     -outputs=NAME,... -grid=NAME:START:STOP:COUNT ... expr_file
+
+    -processes=N                 worker processes (default the number of cpus)
+    -vectorized                  evaluate each chunk over numpy arrays
+    -csv=FILE                    write the results as CSV (default to stdout)
+    -columns=FILE                write the results as a binary columnar file
+    -outputs=NAME,...            the variables to report
+    -grid=NAME:START:STOP:COUNT  COUNT values of NAME from START to STOP inclusive,
+                                 every combination of the grids is evaluated
+"""
+
+import os
+import sys
+import csv
+import struct
+import itertools as it
+from array import array
+from collections import deque
+from multiprocessing import Pool
+
+import expr
+
+CHUNK_SIZE = 1000
+
+########################################
+# Bindings
+########################################
+
+def grid(**axes):
+    """
+    Bindings for every combination of the values of each axis, e.g.
+    grid(theta=[0.0, 0.5], time=[1.0, 2.0])
+    """
+    return (dict(zip(axes, values)) for values in it.product(*axes.values()))
+
+def linspace(start, stop, count):
+    "count values from start to stop inclusive"
+    if count == 1:
+        return [start]
+    return [start + (stop - start) * i / (count - 1) for i in range(count)]
+
+def binding_rows(bindings):
+    """
+    Split an iterable of binding dicts, which all have the same names, into the names
+    and an iterator of tuples of their values
+
+    :return: (names, rows)
+    """
+    bindings = iter(bindings)
+    first = next(bindings, None)
+    if first is None:
+        return ([], iter(()))
+    names = list(first)
+    rows = (tuple(binding[name] for name in names) for binding in it.chain([first], bindings))
+    return (names, rows)
+
+########################################
+# Workers
+########################################
+
+# the ExprSet of a worker process, compiled once by init_worker()
+worker_state = None
+
+def init_worker(trees, names, outputs, vectorized=False):
+    global worker_state
+    worker_state = (expr.ExprSet(trees=trees), names, tuple(outputs), vectorized)
+
+def eval_chunk(rows):
+    "Evaluate the ExprSet of this worker for each row, returning rows of the outputs"
+    expr_set, names, outputs, vectorized = worker_state
+    if vectorized:
+        return eval_chunk_vectorized(expr_set, names, outputs, rows)
+    results = []
+    for row in rows:
+        vs = dict(zip(names, row))
+        expr_set.eval_all(vs, outputs)
+        results.append(tuple(vs[name] for name in outputs))
+    return results
+
+def eval_chunk_vectorized(expr_set, names, outputs, rows):
+    "eval_chunk() as one evaluation over numpy arrays of the columns of rows"
+    import numpy
+    arrays = dict(zip(names, (numpy.array(column) for column in zip(*rows))))
+    vs = expr_set.eval_vectorized(arrays, outputs)
+    return list(zip(*(numpy.broadcast_to(vs[name], len(rows)).tolist() for name in outputs)))
+
+def iter_batch(expr_set, bindings, outputs, processes=None, chunk_size=CHUNK_SIZE,
+        vectorized=False):
+    """
+    Evaluate expr_set for each binding, yielding the rows of the binding values followed
+    by the outputs, in the order of bindings
+
+    The bindings are read as they are needed, and only a few chunks per process are in
+    flight at a time, so memory stays flat however many bindings there are.  Each
+    worker is sent the parse trees once, and compiles them itself; ops and functions
+    added with expr.addBinaryOp and expr.addFunction are only known to workers that fork
+    from this process.
+
+    :param bindings: iterable of dicts of the variables, e.g. from grid()
+    :param outputs: the variables to report, only what they depend on is evaluated
+    :param processes: worker processes, evaluate in this process if 0
+    :param vectorized: evaluate each chunk at once over numpy arrays, with the
+        vector_impl of the functions, the values are then all floats
+    """
+    names, rows = binding_rows(bindings)
+    trees = [(e.orig_expr_tree, e.expr_tree) for e in expr_set.get_exprs()]
+    chunks = iter(lambda: list(it.islice(rows, chunk_size)), [])
+
+    if processes == 0:
+        init_worker(trees, names, outputs, vectorized)
+        for chunk in chunks:
+            yield from (row + result for row, result in zip(chunk, eval_chunk(chunk)))
+        return
+
+    processes = processes or os.cpu_count()
+    with Pool(processes, init_worker, (trees, names, outputs, vectorized)) as pool:
+        pending = deque()
+        def finish():
+            chunk, results = pending.popleft()
+            return (row + result for row, result in zip(chunk, results.get()))
+
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(eval_chunk, (chunk,))))
+            if len(pending) >= 2 * processes:
+                yield from finish()
+        while pending:
+            yield from finish()
+
+def eval_batch(expr_set, bindings, outputs, callback, processes=None, chunk_size=CHUNK_SIZE,
+        vectorized=False):
+    """
+    iter_batch(), calling callback with each row
+
+    :return: the number of rows
+    """
+    count = 0
+    for row in iter_batch(expr_set, bindings, outputs, processes, chunk_size, vectorized):
+        callback(row)
+        count += 1
+    return count
+
+########################################
+# Output
+########################################
+
+def write_csv(open_file, expr_set, bindings, outputs, processes=None, vectorized=False):
+    """
+    Write the rows of iter_batch() as CSV, headed by the column names
+
+    :return: the number of rows
+    """
+    bindings = iter(bindings)
+    first = next(bindings, None)
+    if first is None:
+        return 0
+    writer = csv.writer(open_file)
+    writer.writerow(list(first) + list(outputs))
+    return eval_batch(expr_set, it.chain([first], bindings), outputs,
+            writer.writerow, processes, vectorized=vectorized)
+
+# columnar files are this header, then the column names, then blocks of rows each with
+# a count of the rows, then each column of the block as float64
+COLUMNS_MAGIC = b"EXPRCOLS"
+COLUMNS_HEADER = struct.Struct("<8sI")     # magic, number of columns
+NAME_HEADER = struct.Struct("<I")          # length of the utf-8 name
+BLOCK_HEADER = struct.Struct("<Q")         # number of rows in the block
+
+def write_columns(file_name, expr_set, bindings, outputs, processes=None,
+        block_size=CHUNK_SIZE, vectorized=False):
+    """
+    Write the rows of iter_batch() to a binary columnar file, read with read_columns()
+    all values are stored as float64
+
+    :return: the number of rows
+    """
+    bindings = iter(bindings)
+    first = next(bindings, None)
+    names = ([] if first is None else list(first)) + list(outputs)
+    count = 0
+    with open(file_name, "wb") as open_file:
+        open_file.write(COLUMNS_HEADER.pack(COLUMNS_MAGIC, len(names)))
+        for name in names:
+            name = name.encode("utf-8")
+            open_file.write(NAME_HEADER.pack(len(name)) + name)
+        if first is None:
+            return 0
+
+        def write_block(block):
+            open_file.write(BLOCK_HEADER.pack(len(block)))
+            for column in zip(*block):
+                array('d', (float(value) for value in column)).tofile(open_file)
+
+        block = []
+        for row in iter_batch(expr_set, it.chain([first], bindings), outputs, processes,
+                vectorized=vectorized):
+            block.append(row)
+            if len(block) == block_size:
+                write_block(block)
+                count += len(block)
+                block = []
+        if block:
+            write_block(block)
+            count += len(block)
+    return count
+
+def read_columns(file_name):
+    """
+    Read a file written by write_columns()
+
+    :return: dict of each column name to an array('d') of its values
+    """
+    with open(file_name, "rb") as open_file:
+        data = open_file.read()
+    if len(data) < COLUMNS_HEADER.size:
+        raise Exception("Invalid columns file!")
+    magic, ncolumns = COLUMNS_HEADER.unpack_from(data)
+    if magic != COLUMNS_MAGIC:
+        raise Exception("Invalid columns file!")
+
+    offset = COLUMNS_HEADER.size
+    names = []
+    for i in range(ncolumns):
+        length, = NAME_HEADER.unpack_from(data, offset)
+        offset += NAME_HEADER.size
+        names.append(data[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    columns = [array('d') for name in names]
+    while offset < len(data):
+        nrows, = BLOCK_HEADER.unpack_from(data, offset)
+        offset += BLOCK_HEADER.size
+        for column in columns:
+            column.frombytes(data[offset:offset + 8 * nrows])
+            offset += 8 * nrows
+    return dict(zip(names, columns))
+
+if __name__ == '__main__':
+    processes = None
+    vectorized = False
+    csv_file = None
+    columns_file = None
+    outputs = []
+    axes = {}
+    expr_files = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('-processes='):
+            processes = int(arg[len('-processes='):])
+        elif arg == '-vectorized':
+            vectorized = True
+        elif arg.startswith('-csv='):
+            csv_file = arg[len('-csv='):]
+        elif arg.startswith('-columns='):
+            columns_file = arg[len('-columns='):]
+        elif arg.startswith('-outputs='):
+            outputs = arg[len('-outputs='):].split(',')
+        elif arg.startswith('-grid='):
+            name, start, stop, count = arg[len('-grid='):].split(':')
+            axes[name] = linspace(float(start), float(stop), int(count))
+        elif arg.startswith('-'):
+            print(__doc__)
+            sys.exit(2)
+        else:
+            expr_files.append(arg)
+    if len(expr_files) != 1 or not outputs or not axes:
+        print(__doc__)
+        sys.exit(2)
+
+    expr_set = expr.ExprSet(file_name=expr_files[0])
+    if columns_file:
+        write_columns(columns_file, expr_set, grid(**axes), outputs, processes,
+                vectorized=vectorized)
+    elif csv_file:
+        with open(csv_file, 'w', newline='') as open_file:
+            write_csv(open_file, expr_set, grid(**axes), outputs, processes, vectorized)
+    else:
+        write_csv(sys.stdout, expr_set, grid(**axes), outputs, processes, vectorized)
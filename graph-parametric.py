@@ -1,20 +1,66 @@
 #!/usr/local/bin/python3
 
+import io
+import os
 import sys
 import functools as ft
 import itertools as it
 import math
 import turtle as t
 import re
-from time import sleep
+from time import sleep, perf_counter
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
 import expr
+import interval
+import raster
+import animation
 
 mag_by = 1
 
+# sample curves by their curvature, rather than at a fixed number of points, with -adaptive
+# it takes fewer points for curves that are mostly smooth, but evaluates the curve twice
+adaptive = False
+
+# fraction of the points frames are drawn with, lowered by run() when it falls behind
+detail = 1.0
+
+# the derivatives adaptive sampling uses, see expr.ExprSet.diff
+SLOPE_NAMES = ['dx_dtheta', 'dy_dtheta', 'ddx_dtheta_dtheta', 'ddy_dtheta_dtheta']
+
+# adaptive segments are this many pixels long, at least and at most
+MIN_SEGMENT = 0.5
+MAX_SEGMENT = 20
+
+# frames are drawn with at least this many points, however little the detail
+MIN_POINTS = 64
+
+# halve the range of theta this many times, looking for parts of a curve off screen
+CULL_DEPTH = 5
+
+# most frames to wait before looking again, after looking culled nothing
+MAX_CULL_WAIT = 32
+
+# size of recorded frames
+RECORD_SIZE = (1000, 800)
+
+BACKGROUND = (0.0, 0.0, 0.0)
+
+# frames per second of recorded animations
+FPS = 30
+
+# where -cache keeps the parse trees of the para files between runs
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "py_fun", "expr")
+
+# parse trees of the para files, only in memory unless -cache is given
+expr_cache = expr.ExprCache()
+
 class CurveSet:
     def __init__(self, file_name):
         self.file_name = file_name
-        self.expr_set = expr.ExprSet(file_name=file_name)
+        self.expr_set = expr_cache.get_expr_set(file_name=file_name)
+        self.staged_expr_set = self.expr_set.specialize(['time', 'wave'], ['x', 'y', 'width'])
         self.total_points = self.expr_set.eval_for("points", missing=1000)
         self.wave_speed = self.expr_set.eval_for("wave_speed", missing=0.0)
         self.linear_speed = self.expr_set.eval_for("linear_speed", missing=0.0)
@@ -22,131 +68,578 @@ class CurveSet:
         self.line_width = self.expr_set.eval_for("line_width", missing=1)
         self.screen_size = self.expr_set.eval_for("screen_size", missing=1.0)
         self.points = self.expr_set.eval_for("points", missing=1000)
+        self.pixel_error = self.expr_set.eval_for("pixel_error", missing=0.25)
+        try:
+            self.staged_slope_set = self.expr_set.diff('theta', 2).specialize(
+                    ['time', 'wave'], SLOPE_NAMES)
+        except expr.DiffException:
+            self.staged_slope_set = None
+        try:
+            self.bounds({'theta': interval.Interval(0.0, 2 * math.pi), 'time': 0.0, 'wave': 0.0})
+            self.can_cull = True
+        except expr.EvalException:
+            self.can_cull = False
+        # frames until culling is tried again, and how long to wait next time it culls nothing
+        self.cull_wait = 0
+        self.cull_backoff = 1
 
-        self.color_change_steps = int(self.total_points / 200)
-        if self.color_change_steps == 0:
-            self.color_change_steps = 1
-
-    def draw_frame(self, wave_point, linear_point):
-        global mag_by
-
-        t.up()
-        first = True
-        t.width(self.line_width * mag_by)
-        for i in range(self.total_points + 1):
-            theta = 2 * math.pi * i / self.total_points
-            vs = {
-                    'theta': theta,
-                    'time': linear_point,
-                    'wave': wave_point,
-                    }
-            self.expr_set.eval_all(vs)
-            x = vs['x'] * mag_by
-            y = vs['y'] * mag_by
-            if i % self.color_change_steps == 0:
-                if self.color_spin:
-                    t.color(
-                            0.5*(1+math.sin(theta + linear_point * self.color_spin)),
-                            0.5*(1+math.sin(theta + 2*math.pi/3 + linear_point * self.color_spin)),
-                            0.5*(1+math.sin(theta - 2*math.pi/3 + linear_point * self.color_spin)))
-                if 'width' in vs:
-                    use_width = self.line_width + vs['width']
-                    if use_width < 1:
-                        use_width = 1.0
-                    t.width(use_width * mag_by)
-            if first:
-                t.down()
-                first = False
-            t.goto(x * 100 * self.screen_size, y * 100 * self.screen_size)
-        t.up()
-
-    def draw_frame_count(self, count):
-        self.draw_frame(
-                (1+math.sin(2 * math.pi * count * self.wave_speed))/2,
-                count * self.linear_speed)
-
-
-### START: trying to save screen shots
 
-import io
-from PIL import Image
+    def point_count(self):
+        "The most points a frame is drawn with, at the current detail"
+        return min(self.total_points, max(MIN_POINTS, int(self.total_points * detail)))
+
+    def sample_thetas(self, wave_point, linear_point, scale):
+        """
+        The thetas to draw a frame at, spaced so that each segment strays at most
+        pixel_error from the curve, using the speed and curvature on a coarse grid
+        when that takes as many as points, they are spaced evenly as without sampling;
+        less detail spaces them further apart
+        """
+        coarse = max(64, self.total_points // 2)
+        thetas = 2 * math.pi * np.arange(coarse + 1) / coarse
+        eval_slopes = self.staged_slope_set.bind_vectorized({
+                'time': linear_point,
+                'wave': wave_point,
+                })
+        vs = eval_slopes({'theta': thetas})
+        dx, dy, ddx, ddy = (np.broadcast_to(vs[name] * scale, thetas.shape) for name in SLOPE_NAMES)
+
+        speed = np.hypot(dx, dy)
+        curvature = np.abs(dx * ddy - dy * ddx) / np.maximum(speed ** 3, 1e-12)
+        # a chord of length L on an arc of curvature k strays k L^2 / 8 from it
+        segment = np.clip(
+                np.sqrt(8 * self.pixel_error * mag_by / np.maximum(curvature, 1e-12)),
+                MIN_SEGMENT * mag_by, MAX_SEGMENT * mag_by)
+        # samples per radian, with a few even where the curve doesn't move
+        density = np.maximum(speed / segment, 8 / (2 * math.pi))
+        cumulative = np.concatenate(([0.0], np.cumsum(
+                (density[1:] + density[:-1]) / 2 * np.diff(thetas))))
+        count = math.ceil(cumulative[-1] * detail)
+        points = self.point_count()
+        if count >= points:
+            return 2 * math.pi * np.arange(points + 1) / points
+        return np.interp(np.linspace(0.0, cumulative[-1], count + 1), cumulative, thetas)
+
+    def bounds(self, vs):
+        """
+        Intervals bounding x, y and the line width in screen units, for every theta in
+        the interval.Interval vs['theta']
+        """
+        bounds = self.expr_set.eval_interval(vs, ('x', 'y', 'width'))
+        scale = mag_by * 100 * self.screen_size
+        width = self.line_width
+        if 'width' in bounds:
+            width = interval.Interval.of(width + bounds['width']).hi
+        return (
+            interval.Interval.of(bounds['x']) * scale,
+            interval.Interval.of(bounds['y']) * scale,
+            max(width, 1.0) * mag_by)
+
+    def visible_pieces(self, wave_point, linear_point, half_width, half_height):
+        """
+        The (lo, hi) ranges of theta where the curve may be on a screen of the given size,
+        halving the ranges partly on screen CULL_DEPTH times
+        """
+        vs = {'time': linear_point, 'wave': wave_point}
+        pieces = []
+        def visit(lo, hi, depth):
+            vs['theta'] = interval.Interval(lo, hi)
+            x, y, width = self.bounds(vs)
+            x_limit = half_width + width
+            y_limit = half_height + width
+            if x.hi < -x_limit or x.lo > x_limit or y.hi < -y_limit or y.lo > y_limit:
+                return
+            if depth == 0 or (-x_limit <= x.lo and x.hi <= x_limit
+                    and -y_limit <= y.lo and y.hi <= y_limit):
+                pieces.append((lo, hi))
+                return
+            mid = (lo + hi) / 2
+            visit(lo, mid, depth - 1)
+            visit(mid, hi, depth - 1)
+        visit(0.0, 2 * math.pi, CULL_DEPTH)
+        return pieces
+
+    def frame_thetas(self, wave_point, linear_point):
+        "The thetas a frame is drawn at, sampled adaptively if it can be"
+        if adaptive and self.staged_slope_set:
+            return self.sample_thetas(wave_point, linear_point, mag_by * 100 * self.screen_size)
+        points = self.point_count()
+        return 2 * math.pi * np.arange(points + 1) / points
+
+    def frame_points(self, wave_point, linear_point, half_width, half_height):
+        """
+        The points the curve of a frame is drawn through, in screen units, on a screen
+        of the given size
+
+        :return: (thetas, xs, ys, widths, visible) arrays, widths is None if the curve
+            doesn't set width, visible is False at the first point and at the points
+            ending a segment which can't be on screen
+        """
+        thetas = self.frame_thetas(wave_point, linear_point)
+        eval_frame = self.staged_expr_set.bind_vectorized({
+                'time': linear_point,
+                'wave': wave_point,
+                })
+        vs = eval_frame({'theta': thetas})
+        xs = np.broadcast_to(vs['x'] * mag_by * 100 * self.screen_size, thetas.shape)
+        ys = np.broadcast_to(vs['y'] * mag_by * 100 * self.screen_size, thetas.shape)
+        widths = None
+        if 'width' in vs:
+            widths = np.maximum(self.line_width + vs['width'], 1.0) * mag_by
+            widths = np.broadcast_to(widths, thetas.shape)
+
+        visible = np.ones(thetas.shape, dtype=bool)
+        if self.can_cull and self.cull_wait:
+            self.cull_wait -= 1
+        elif self.can_cull:
+            visible = self.visible_segments(
+                    thetas, xs, ys, widths, wave_point, linear_point, half_width, half_height)
+        return (thetas, xs, ys, widths, visible)
+
+    def visible_segments(self, thetas, xs, ys, widths, wave_point, linear_point,
+            half_width, half_height):
+        """
+        The visible of frame_points(), True where the segment ending at a point has a
+        range of theta overlapping a piece that may be on screen
+
+        The pieces are only looked for if the ends of some segment are both off screen,
+        as otherwise every segment is drawn anyway.  When the pieces cull nothing, as
+        when the bounds are loose, looking again waits for twice as many frames as the
+        last time, up to MAX_CULL_WAIT.  Culled segments cover no pixels, so frames
+        look the same whether or not they were culled.
+        """
+        visible = np.ones(thetas.shape, dtype=bool)
+        reach = self.line_width * mag_by if widths is None else widths
+        off = (np.abs(xs) > half_width + reach) | (np.abs(ys) > half_height + reach)
+        if not (off[1:] & off[:-1]).any():
+            return visible
+
+        pieces = self.visible_pieces(wave_point, linear_point, half_width, half_height)
+        visible[:] = False
+        if pieces:
+            # the pieces are in order, so count those starting by the end of each
+            # segment, and those ending before its start
+            los = np.array([lo for lo, hi in pieces])
+            his = np.array([hi for lo, hi in pieces])
+            visible[1:] = (np.searchsorted(los, thetas[1:], side='right')
+                    > np.searchsorted(his, thetas[:-1], side='left'))
+        if visible[1:].all():
+            self.cull_wait = self.cull_backoff
+            self.cull_backoff = min(2 * self.cull_backoff, MAX_CULL_WAIT)
+        else:
+            self.cull_backoff = 1
+        return visible
+
+    def colors(self, thetas, linear_point):
+        "The (r, g, b) of the curve at each of thetas"
+        spin = linear_point * self.color_spin
+        return 0.5 * (1 + np.sin(np.stack([
+                thetas + spin,
+                thetas + 2*math.pi/3 + spin,
+                thetas - 2*math.pi/3 + spin], axis=1)))
+
+    def profile_frame(self, wave_point, linear_point):
+        """
+        Evaluate a frame with an ExprProfiler as frame_points() does, staged and over the
+        array of its thetas, returning its report
+        """
+        profiler = expr.ExprProfiler(self.staged_expr_set, vectorized=True)
+        profiler.eval_all({
+                'theta': self.frame_thetas(wave_point, linear_point),
+                'time': linear_point,
+                'wave': wave_point,
+                })
+        return profiler.report()
+
+    def draw_frame(self, lines, wave_point, linear_point, stats=None):
+        """
+        Draw a frame with lines, a raster.Raster or CanvasLines, changing the color and
+        width every color_change_steps() points
+
+        :param stats: if given, a FrameStats to add the time evaluating and drawing to
+        """
+        start = perf_counter()
+        thetas, xs, ys, widths, visible = self.frame_points(
+                wave_point, linear_point, lines.width / 2, lines.height / 2)
+        # the index of the point at which the color and width of each point were set
+        steps = color_change_steps(len(thetas))
+        held = np.arange(len(thetas)) // steps * steps
+        colors = None
+        if self.color_spin:
+            colors = self.colors(thetas[held], linear_point)
+        if widths is None:
+            widths = self.line_width * mag_by
+        else:
+            widths = widths[held]
+        evaluated = perf_counter()
+        lines.draw_polyline(xs, ys, widths, colors, visible)
+        if stats:
+            stats.add('eval', evaluated - start)
+            stats.add('draw', perf_counter() - evaluated)
+
+    def frame_time(self, count):
+        "The (wave_point, linear_point) of frame count"
+        return ((1+math.sin(2 * math.pi * count * self.wave_speed))/2, count * self.linear_speed)
+
+    def draw_frame_count(self, lines, count, stats=None):
+        self.draw_frame(lines, *self.frame_time(count), stats)
+
+def color_change_steps(point_count):
+    "How many points are drawn between changes of the color and width of a curve"
+    return max(1, int((point_count - 1) / 200))
+
 
 def draw_background(color):
-    if not do_record:
-        t.bgcolor(color)
-    else:
-        height = 10000
-        width = 10000
-
-        penposn = t.position()
-        penstate = t.pen()
-
-        t.penup()
-        t.speed(0)  # fastest
-        t.goto(-width/2-2, -height/2+3)
-        t.fillcolor(color)
-        t.begin_fill()
-        t.setheading(0)
-        t.forward(width)
-        t.setheading(90)
-        t.forward(height)
-        t.setheading(180)
-        t.forward(width)
-        t.setheading(270)
-        t.forward(height)
-        t.end_fill()
-
-        t.penup()
-        t.setposition(*penposn)
-        t.pen(penstate)
-
-def save_screen(name):
-    global mag_by
-
-    cnv = t.getscreen().getcanvas() 
-    x=1000
-    y=800
-    mag_by=4
-    post_script = cnv.postscript(colormode = 'color', width=x*mag_by+1, height=y*mag_by+1, x=-(mag_by*x)//2, y=-(mag_by*y)//2)
-    im = Image.open(io.BytesIO(post_script.encode('utf-8')))
-    if mag_by != 1:
+    t.bgcolor(color)
+
+########################################
+# Canvas drawing
+########################################
+
+def color_string(color):
+    "Tk color of an (r, g, b) from 0 to 1, as turtle makes it"
+    return "#%02x%02x%02x" % tuple(round(255.0 * c) for c in color)
+
+class CanvasLines(object):
+    """
+    Draws polylines on a Tk canvas, as raster.Raster draws them, with one line item for
+    each run of segments of the same color and width
+
+    The items of the last frame are moved and recolored to draw the next frame, rather
+    than deleted and made again, and the ones left over are hidden.  Items are used in
+    the order they were made, so what is drawn later is on top.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.items = []
+        self.used = 0
+        self.shown = 0
+        # like a turtle's pen, lines drawn without colors are the last color used
+        self.pen_color = "#000000"
+        self.width = 0
+        self.height = 0
+
+    def start_frame(self, width, height):
+        "Start drawing a frame on a window of the given size"
+        self.width = width
+        self.height = height
+        self.used = 0
+
+    def finish_frame(self):
+        "Hide the items the frame didn't use"
+        for item in self.items[self.used:self.shown]:
+            self.canvas.itemconfigure(item, state="hidden")
+        self.shown = self.used
+
+    def draw_polyline(self, xs, ys, widths, colors=None, visible=None):
+        "See raster.Raster.draw_polyline()"
+        xs = np.asarray(xs, dtype=float)
+        if len(xs) < 2:
+            return
+        widths = np.broadcast_to(np.asarray(widths, dtype=float), xs.shape)
+        drawn = np.ones(len(xs) - 1, dtype=bool)
+        if visible is not None:
+            drawn = np.asarray(visible, dtype=bool)[1:]
+
+        # a run starts at a segment drawn after one not drawn, or of another color or width
+        change = np.ones(len(xs) - 1, dtype=bool)
+        change[1:] = (widths[2:] != widths[1:-1]) | ~drawn[:-1]
+        if colors is not None:
+            colors = np.asarray(colors, dtype=float)
+            change[1:] |= np.any(colors[2:] != colors[1:-1], axis=1)
+        starts = np.nonzero(drawn & change)[0]
+        breaks = np.nonzero(change[1:] | ~drawn[1:])[0] + 1
+        ends = np.append(breaks, len(xs) - 1)[np.searchsorted(breaks, starts, side='right')]
+
+        # canvas coordinates have y down
+        coords = np.empty(2 * len(xs))
+        coords[0::2] = xs
+        coords[1::2] = -np.asarray(ys, dtype=float)
+        coords = coords.tolist()
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if colors is not None:
+                self.pen_color = color_string(colors[start + 1])
+            self.draw_line(coords[2 * start:2 * end + 2], self.pen_color, widths[start + 1])
+        if colors is not None:
+            self.pen_color = color_string(colors[-1])
+
+    def draw_line(self, coords, color, width):
+        if self.used < len(self.items):
+            item = self.items[self.used]
+            self.canvas.coords(item, coords)
+            if self.used < self.shown:
+                self.canvas.itemconfigure(item, fill=color, width=width)
+            else:
+                self.canvas.itemconfigure(item, fill=color, width=width, state="normal")
+        else:
+            self.items.append(self.canvas.create_line(coords, fill=color, width=width,
+                    capstyle="round", joinstyle="round"))
+        self.used += 1
+
+########################################
+# Recording
+########################################
+
+def record_frame(curve_sets, count):
+    "Draw frame count of the curve_sets into a raster.Raster of RECORD_SIZE, with no display"
+    frame = raster.Raster(*RECORD_SIZE, background=BACKGROUND)
+    for curve_set in curve_sets:
+        curve_set.draw_frame_count(frame, count)
+    return frame
+
+# the CurveSets of a worker process, made once by init_worker()
+worker_curve_sets = None
+
+def init_worker(file_names, adaptive_sampling, cache_path=None):
+    global worker_curve_sets, adaptive, expr_cache
+    adaptive = adaptive_sampling
+    if cache_path:
+        expr_cache = expr.ExprCache(path=cache_path)
+    worker_curve_sets = [CurveSet(file_name) for file_name in file_names]
+
+def render_png(count):
+    "Frame count of the CurveSets of this worker, as PNG data"
+    open_file = io.BytesIO()
+    record_frame(worker_curve_sets, count).to_image().save(open_file, "PNG")
+    return open_file.getvalue()
+
+def render_rgb(count):
+    "Frame count of the CurveSets of this worker, as bytes of RGB pixels"
+    return record_frame(worker_curve_sets, count).to_image().tobytes()
+
+def iter_frames(file_names, frames, processes=None, render=render_png):
+    """
+    Render the first frames of the CurveSets of file_names, yielding them in order
+
+    Each frame depends only on its count, so frames are spread over a process pool,
+    with only a few per process in flight at a time.  Each worker makes its own
+    CurveSets, and renders whole frames.
+
+    :param processes: worker processes, render in this process if 0
+    :param render: function of the count of a frame, run in the workers
+    """
+    if processes == 0:
+        init_worker(file_names, adaptive, expr_cache.path)
+        for count in range(frames):
+            yield render(count)
+        return
+
+    processes = processes or os.cpu_count()
+    with Pool(processes, init_worker, (file_names, adaptive, expr_cache.path)) as pool:
+        pending = deque()
+        for count in range(frames):
+            pending.append(pool.apply_async(render, (count,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def record(file_names, frames, processes=None, output=None, fps=FPS):
+    """
+    Write the first frames as x.000.png, x.001.png, ..., or as they are rendered to
+    the animation output, see animation.open_writer()
+    """
+    if output:
+        with animation.open_writer(output, frames, RECORD_SIZE, fps) as writer:
+            render = render_png if writer.frame_format == "png" else render_rgb
+            for count, data in enumerate(iter_frames(file_names, frames, processes, render)):
+                writer.write_frame(data)
+                print("frame: %d"%(count))
+        return
+    for count, data in enumerate(iter_frames(file_names, frames, processes)):
+        name = 'x.%03d.png' % count
+        with open(name, 'wb') as open_file:
+            open_file.write(data)
         print("save: %s"%(name))
-        im = im.resize((x, y), resample = Image.ANTIALIAS)
-    im.save(name + ".png", "PNG")
 
-### END: trying to save screen shots
+########################################
+# Reloading
+########################################
+
+def file_version(file_name):
+    "What changes when file_name is written, None if it can't be read"
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+class CurveFiles(object):
+    """
+    The CurveSets of para files, each made again when its file changes
 
+    Only the changed files are parsed again, the other CurveSets keep their compiled
+    state.  If a changed file can't be made into a CurveSet, the last good one is kept.
+    """
+
+    def __init__(self, file_names):
+        self.curve_sets = [CurveSet(file_name) for file_name in file_names]
+        self.versions = [file_version(file_name) for file_name in file_names]
+
+    def reload(self):
+        "Remake the CurveSets of the files changed since the last reload"
+        for i, curve_set in enumerate(self.curve_sets):
+            version = file_version(curve_set.file_name)
+            if version == self.versions[i]:
+                continue
+            self.versions[i] = version
+            try:
+                self.curve_sets[i] = CurveSet(curve_set.file_name)
+            except Exception as e:
+                print("%s: %s, keeping the last version" % (curve_set.file_name, e))
+                continue
+            print("reload: %s" % (curve_set.file_name))
+
+########################################
+# Frame scheduling
+########################################
+
+# frames the timing stats are averaged over
+STATS_FRAMES = 60
+
+# seconds between reports of the timing stats
+STATS_INTERVAL = 2.0
+
+# the least detail frames are coarsened to when drawing falls behind
+MIN_DETAIL = 0.25
+
+class FrameStats(object):
+    """
+    Rolling times of the phases of the last STATS_FRAMES frames, to tell whether
+    evaluating the curves, drawing them, or the window updating is slow
+    """
+
+    PHASES = ['eval', 'draw', 'update']
+
+    def __init__(self):
+        self.frames = deque(maxlen=STATS_FRAMES)
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.skipped = 0
+
+    def add(self, phase, seconds):
+        "Add seconds to the time of phase in this frame"
+        self.current[phase] += seconds
+
+    def finish_frame(self, seconds, end):
+        "Finish this frame, which took seconds and ended at the perf_counter() end"
+        self.current['frame'] = seconds
+        self.current['end'] = end
+        self.frames.append(self.current)
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+
+    def report(self):
+        "One line of the frame rate, the mean time of each phase, and the frames skipped"
+        if len(self.frames) < 2:
+            return "no frames"
+        def mean_ms(name):
+            return 1000 * sum(frame[name] for frame in self.frames) / len(self.frames)
+        fps = (len(self.frames) - 1) / (self.frames[-1]['end'] - self.frames[0]['end'])
+        return "%5.1f fps  frame %6.1f ms  %s  skipped %d  detail %.2f" % (
+                fps, mean_ms('frame'),
+                "  ".join("%s %6.1f ms" % (phase, mean_ms(phase)) for phase in self.PHASES),
+                self.skipped, detail)
 
 mag_by = 1
 
-def run(curve_sets):
-    global t
+def run(curve_files, fps=FPS, show_stats=False):
+    """
+    Draw frames forever at fps, swapping in the changed para files of curve_files
+    between frames
+
+    When a frame takes longer than 1 / fps, the detail of the next ones is lowered,
+    and when it falls a whole frame behind, frames are skipped so the animation keeps
+    its speed.  Detail comes back up once frames are quick again.
+
+    :param show_stats: show the FrameStats on the window, and print them
+    """
+    global t, detail
 
     t.penup()
     t.tracer(0)
     t.hideturtle()
+    draw_background(BACKGROUND)
 
+    canvas = t.getcanvas()
+    lines = CanvasLines(canvas)
+    stats = FrameStats()
+    stats_text = None
+    period = 1 / fps
     count = 0
+    next_frame = perf_counter()
+    next_report = next_frame + STATS_INTERVAL
     while True:
-        t.clear()
-        draw_background((0.0, 0.0, 0.0))
-        for curve_set in curve_sets:
-            curve_set.draw_frame_count(count)
-        count += 1
+        start = perf_counter()
+        curve_files.reload()
+        lines.start_frame(t.window_width(), t.window_height())
+        for curve_set in curve_files.curve_sets:
+            curve_set.draw_frame_count(lines, count, stats)
+        lines.finish_frame()
+        updating = perf_counter()
         t.update()
-        if do_record:
-            save_screen('x.%03d'%(count-1))
-            if count == do_record:
-                return
+        end = perf_counter()
+        stats.add('update', end - updating)
+        stats.finish_frame(end - start, end)
+
+        if end - start > period:
+            detail = max(MIN_DETAIL, detail * 0.8)
+        elif end - start < period / 2:
+            detail = min(1.0, detail * 1.1)
+        next_frame += period
+        if end < next_frame:
+            sleep(next_frame - end)
+        else:
+            behind = int((end - next_frame) / period)
+            count += behind
+            next_frame += behind * period
+            stats.skipped += behind
+        count += 1
 
-args = sys.argv[1:]
-curve_sets = [CurveSet(file_name) for file_name in args if not file_name.startswith('-')]
-do_record=0
+        if show_stats and end >= next_report:
+            report = stats.report()
+            print(report)
+            if stats_text is None:
+                stats_text = canvas.create_text(
+                        -lines.width / 2 + 10, -lines.height / 2 + 10, anchor="nw",
+                        fill="white", font=("Courier", 10), text=report)
+            else:
+                canvas.itemconfigure(stats_text, text=report)
+                canvas.tag_raise(stats_text)
+            next_report = end + STATS_INTERVAL
 
-if '-4' in args:
-    do_record=3
-    mag_by = 4
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    adaptive = '-adaptive' in args
+    file_names = [file_name for file_name in args if not file_name.startswith('-')]
+    do_record=0
+    processes = None
+    output = None
+    fps = FPS
 
+    if '-4' in args:
+        do_record=3
+    for arg in args:
+        if arg.startswith('-record='):
+            do_record = int(arg[len('-record='):])
+        elif arg.startswith('-processes='):
+            processes = int(arg[len('-processes='):])
+        elif arg.startswith('-output='):
+            output = arg[len('-output='):]
+        elif arg.startswith('-fps='):
+            fps = float(arg[len('-fps='):])
+        elif arg == '-cache':
+            expr_cache = expr.ExprCache(path=CACHE_PATH)
+        elif arg.startswith('-cache='):
+            expr_cache = expr.ExprCache(path=arg[len('-cache='):])
+    curve_files = CurveFiles(file_names)
 
-run(curve_sets)
+    if '-profile' in args:
+        for curve_set in curve_files.curve_sets:
+            print(curve_set.file_name)
+            print(curve_set.profile_frame(0.5, 0.0))
+
+    if do_record:
+        record(file_names, do_record, processes, output, fps)
+    else:
+        run(curve_files, fps, '-stats' in args)
 
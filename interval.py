@@ -0,0 +1,156 @@
+import math
+
+TWO_PI = 2 * math.pi
+INF = float("inf")
+
+def down(value):
+    "value rounded out, toward -inf, to cover the rounding of the operation that made it"
+    return math.nextafter(value, -INF)
+
+def up(value):
+    "value rounded out, toward +inf"
+    return math.nextafter(value, INF)
+
+
+class Interval(object):
+    """
+    Closed interval [lo, hi] of floats, the arithmetic on which bounds the result for
+    every value in the operands; each bound is rounded outward, so the bounds hold
+    despite float rounding
+    """
+
+    __slots__ = ("lo", "hi")
+
+    def __init__(self, lo, hi=None):
+        if hi is None:
+            hi = lo
+        if lo > hi:
+            raise ValueError("Interval with lo > hi")
+        self.lo = lo
+        self.hi = hi
+
+    @staticmethod
+    def of(value):
+        "value as an Interval, None if it isn't a number"
+        if type(value) is Interval:
+            return value
+        if type(value) in [int, float]:
+            return Interval(value, value)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return Interval(value, value)
+
+    def width(self):
+        return self.hi - self.lo
+
+    def mid(self):
+        return (self.lo + self.hi) / 2
+
+    def split(self):
+        "The two halves of the Interval"
+        mid = self.mid()
+        return (Interval(self.lo, mid), Interval(mid, self.hi))
+
+    def __contains__(self, value):
+        return self.lo <= value <= self.hi
+
+    def __or__(self, other):
+        "The smallest Interval covering both"
+        other = Interval.of(other)
+        if other is None:
+            return NotImplemented
+        return Interval(min(self.lo, other.lo), max(self.hi, other.hi))
+
+    __ror__ = __or__
+
+    def __eq__(self, other):
+        return type(other) is Interval and self.lo == other.lo and self.hi == other.hi
+
+    def __hash__(self):
+        return hash((self.lo, self.hi))
+
+    def __neg__(self):
+        return Interval(-self.hi, -self.lo)
+
+    def __add__(self, other):
+        other = Interval.of(other)
+        if other is None:
+            return NotImplemented
+        return Interval(down(self.lo + other.lo), up(self.hi + other.hi))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = Interval.of(other)
+        if other is None:
+            return NotImplemented
+        return Interval(down(self.lo - other.hi), up(self.hi - other.lo))
+
+    def __rsub__(self, other):
+        other = Interval.of(other)
+        if other is None:
+            return NotImplemented
+        return other - self
+
+    def __mul__(self, other):
+        other = Interval.of(other)
+        if other is None:
+            return NotImplemented
+        products = [
+            self.lo * other.lo, self.lo * other.hi,
+            self.hi * other.lo, self.hi * other.hi]
+        # 0 * inf is nan, where the bound is 0
+        products = [0.0 if p != p else p for p in products]
+        return Interval(down(min(products)), up(max(products)))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        other = Interval.of(other)
+        if other is None:
+            return NotImplemented
+        if other.lo <= 0 <= other.hi:
+            # dividing by an interval around 0 may give anything
+            return Interval(-INF, INF)
+        return self * Interval(down(1 / other.hi), up(1 / other.lo))
+
+    def __rtruediv__(self, other):
+        other = Interval.of(other)
+        if other is None:
+            return NotImplemented
+        return other / self
+
+    def __repr__(self):
+        return "Interval(%r, %r)" % (self.lo, self.hi)
+
+    def __str__(self):
+        return "[%s, %s]" % (self.lo, self.hi)
+
+
+def reaches(interval, peak):
+    "Test if interval contains peak + 2 pi k, for some integer k"
+    k = math.ceil((interval.lo - peak) / TWO_PI)
+    # pi isn't exact, so be generous by a little
+    return peak + TWO_PI * k <= interval.hi + 1e-12 * max(1.0, abs(interval.hi))
+
+def periodic(interval, func, max_at, min_at):
+    if interval.hi - interval.lo >= TWO_PI or interval.lo == -INF or interval.hi == INF:
+        return Interval(-1.0, 1.0)
+    ends = [func(interval.lo), func(interval.hi)]
+    lo = -1.0 if reaches(interval, min_at) else max(-1.0, down(min(ends)))
+    hi = 1.0 if reaches(interval, max_at) else min(1.0, up(max(ends)))
+    return Interval(lo, hi)
+
+def sin(value):
+    "sin of a number, or the bounds of sin over an Interval"
+    if type(value) is not Interval:
+        return math.sin(value)
+    return periodic(value, math.sin, math.pi / 2, -math.pi / 2)
+
+def cos(value):
+    "cos of a number, or the bounds of cos over an Interval"
+    if type(value) is not Interval:
+        return math.cos(value)
+    return periodic(value, math.cos, 0.0, math.pi)
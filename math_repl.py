@@ -5,6 +5,7 @@ import fraction
 
 expr.addBinaryOp("//", 2, lambda a,b: fraction.Fraction(int(a),int(b)))
 
+cache = expr.ExprCache()
 vs = {}
 while True:
     e = input("expr: ")
@@ -18,7 +19,7 @@ while True:
         vs = {}
     else:
         try:
-            e = expr.Expr(e)
+            e = cache.get_expr(e)
             print(repr(e.expr_tree))
             print(repr(e.eval(vs)))
         except expr.ParseException as e:
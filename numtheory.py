@@ -1,4 +1,5 @@
 from math import sqrt,log
+from time import perf_counter
 from secrets import randbelow
 from functools import reduce
 from bisect import bisect_left, bisect_right
@@ -17,15 +18,109 @@ __all__ = [
     # factoring and friends
     'factor', 'divisors', 'proper_divisors',
     'gcd', 'lcm',
-    'carmichael_lambda', 'carmichael_lambda_list'
+    'carmichael_lambda', 'carmichael_lambda_list',
+
+    # discrete logarithms
+    'discrete_log',
+
+    # chinese remainder theorem
+    'crt', 'CRTBasis',
 
     # curiosities
     'is_abundant', 'is_amicable', 'is_deficient', 'is_perfect',
+
+    # instrumentation
+    'stats_enable', 'stats_reset', 'stats', 'add_stats_hook', 'remove_stats_hook',
     ]
 
 # Prime Cache Limit
 PCL = 500*1000*1000
 
+# Baby-step Giant-step Limit, the most table entries discrete_log will hold
+BSGS_LIMIT = 1 << 20
+
+########################################
+# Instrumentation
+########################################
+
+# statistics are only collected after stats_enable()
+__stats_on = False
+__stats = {}
+__stats_hooks = []
+
+def stats_enable(on=True):
+    """
+    Turn collection of statistics on or off
+    when off, each instrumented point costs a single test of a flag
+    """
+    global __stats_on
+    __stats_on = on
+
+def stats_reset():
+    """
+    Clear all collected statistics
+    """
+    __stats.clear()
+
+def stats():
+    """
+    A snapshot of the statistics collected so far
+
+        sieve.expansions                count of prime cache expansions
+        sieve.seconds                   time spent expanding the prime cache
+        sieve.history                   list of (old limit, new limit, seconds) for each expansion
+        primes.cached                   primes read from the cache by primes_to, not_primes_to and factor
+        primes.computed                 primes beyond the cache, found with probably_prime
+        probably_prime.calls            calls to probably_prime
+        probably_prime.branch.<name>    calls answered by each branch of probably_prime
+        probably_prime.witnesses        Miller-Rabin rounds run
+        factor.calls                    calls to factor
+        factor.trial_divisions          trial divisions made by factor
+        factor.seconds                  time spent in factor
+
+    :return: dict of statistic name to value
+    """
+    return dict((k, list(v) if type(v) is list else v) for k, v in __stats.items())
+
+def add_stats_hook(func):
+    """
+    Call func(name, value) each time a statistic is recorded, while statistics are enabled
+    value is the amount added, or the (old limit, new limit, seconds) of a sieve expansion
+    """
+    __stats_hooks.append(func)
+
+def remove_stats_hook(func):
+    __stats_hooks.remove(func)
+
+def __stat(name, value=1):
+    __stats[name] = __stats.get(name, 0) + value
+    for hook in __stats_hooks:
+        hook(name, value)
+
+def __stat_primes(i, computed, unused):
+    """
+    Add the primes served, from walking the cache to index i and computing computed past it,
+    where the last prime read was unused, e.g. past the limit
+    :return: the number of primes served
+    """
+    cached = i+1
+    if unused:
+        if computed:
+            computed -= 1
+        else:
+            cached -= 1
+    __stat('primes.cached', cached)
+    if computed:
+        __stat('primes.computed', computed)
+    return cached + computed
+
+def __stat_sieve(old_limit, new_limit, seconds):
+    __stat('sieve.expansions')
+    __stat('sieve.seconds', seconds)
+    __stats.setdefault('sieve.history', []).append((old_limit, new_limit, seconds))
+    for hook in __stats_hooks:
+        hook('sieve.history', (old_limit, new_limit, seconds))
+
 def gcd(a, b):
     """
     Compute greatest common divisor of a and b
@@ -124,7 +219,13 @@ def __sieve_Eratosthenes(upto):
     if upto > PCL:
         upto = PCL
 
+    if __stats_on:
+        t0 = perf_counter()
+        old_limit = last_prime
+
     limit = int(sqrt(upto))+1
+
+    # bit i represents the odd number 2*i+1, the odd multiples of p are every p'th bit
     bm = BitMap(upto//2)
 
     # "sieve in" known primes
@@ -133,26 +234,25 @@ def __sieve_Eratosthenes(upto):
             start = 3*p
             if start < last_prime:
                 start += (2*p)*((2*p - 1 + last_prime - start)//(2*p))
-            for pm in range(start, upto, 2*p):
-                bm.set(pm//2)
+            bm.set_range(start//2, upto//2, p)
 
     # "sieve in" new primes, record primes less than sqrt(upto)
     for i in range(last_prime+2, limit, 2):
         if not bm.test(i//2):
             __primes.append(i)
-            for pm in range(3*i, upto, 2*i):
-                bm.set(pm//2)
+            bm.set_range(3*i//2, upto//2, i)
 
     # record primes larger that sqrt(upto)
     last_prime = __primes[-1]
-    for j in range(last_prime+2, upto, 2):
-        if not bm.test(j//2):
-            __primes.append(j)
+    __primes.extend(2*j+1 for j in bm.iter_clear(last_prime//2 + 1, upto//2))
 
     # add one more, so that algorithms that need to see the "one that's too big" will get it from the cache
     last_prime = __primes[-1]
     __primes.append(next_probably_prime(last_prime))
 
+    if __stats_on:
+        __stat_sieve(old_limit, upto, perf_counter() - t0)
+
 def random_prime_to(limit):
     """
     Return one prime (p) with 1 < p <= limit.
@@ -183,16 +283,25 @@ def primes_to(limit):
     pl = len(__primes)-1
 
     i = 0
+    computed = 0
+    unused = 0
     p = __primes[i]
-    while p <= limit:
-        yield p
-        if i < pl:
-            i += 1
-            p = __primes[i]
-        else:
-            p += 2
-            while not probably_prime(p):
+    try:
+        while p <= limit:
+            yield p
+            if i < pl:
+                i += 1
+                p = __primes[i]
+            else:
+                computed += 1
                 p += 2
+                while not probably_prime(p):
+                    p += 2
+        else:
+            unused = 1
+    finally:
+        if __stats_on:
+            __stat_primes(i, computed, unused)
 
 
 def not_primes_to(limit):
@@ -210,23 +319,32 @@ def not_primes_to(limit):
     pl = len(__primes)-1
 
     i = 0
+    computed = 0
+    unused = 0
     np = 1
     p = __primes[i]
-    while p <= limit:
-        while np < p:
+    try:
+        while p <= limit:
+            while np < p:
+                yield np
+                np += 1
+            np = p + 1
+            if i < pl:
+                i += 1
+                p = __primes[i]
+            else:
+                computed += 1
+                p += 2
+                while not probably_prime(p):
+                    p += 2
+        else:
+            unused = 1
+        while np <= limit:
             yield np
             np += 1
-        np = p + 1
-        if i < pl:
-            i += 1
-            p = __primes[i]
-        else:
-            p += 2
-            while not probably_prime(p):
-                p += 2
-    while np <= limit:
-        yield np
-        np += 1
+    finally:
+        if __stats_on:
+            __stat_primes(i, computed, unused)
 
 
 def factor(n, upto=0):
@@ -238,12 +356,17 @@ def factor(n, upto=0):
     """
     global __primes
 
+    if __stats_on:
+        t0 = perf_counter()
+
     limit = int(sqrt(n))+1
-    __sieve_Eratosthenes(limit)
+    __sieve_Eratosthenes(min(limit, upto) if upto else limit)
     pl = len(__primes)-1
 
     factors = []
     i = 0
+    computed = 0
+    unused = 0
     p = 2
     while p <= limit and (not upto or p < upto):
         c = 0
@@ -259,11 +382,19 @@ def factor(n, upto=0):
             i += 1
             p = __primes[i]
         else:
+            computed += 1
             p += 2
             while not probably_prime(p):
                 p += 2
+    else:
+        unused = 1
     if n > 1:
         factors.append((1, n))
+
+    if __stats_on:
+        __stat('factor.calls')
+        __stat('factor.trial_divisions', __stat_primes(i, computed, unused))
+        __stat('factor.seconds', perf_counter() - t0)
     return factors
 
 
@@ -353,6 +484,11 @@ def is_abundant(n):
     return n < sum_proper_divisors(n)
 
 
+def __small_primes(upto):
+    "The cached primes p <= upto, read without counting them in the statistics"
+    __sieve_Eratosthenes(upto)
+    return __primes[:bisect_right(__primes, upto)]
+
 def probably_prime(n):
     """
     Test any number for primality
@@ -361,29 +497,43 @@ def probably_prime(n):
     note: values taken from https://primes.utm.edu/prove/prove2_3.html
     """
     if n < 2:
+        if __stats_on:
+            __stat('probably_prime.calls')
+            __stat('probably_prime.branch.below_2')
         return False
 
     # quick scan to weed out many values
     upto = 53
     if upto*upto >= n:
         upto = int(sqrt(n))+1
-    for a in primes_to(upto):
+    for a in __small_primes(upto):
         if n%a == 0:
+            if __stats_on:
+                __stat('probably_prime.calls')
+                __stat('probably_prime.branch.small_factor')
             return False
 
     # choose list of values for Miller-Rabin test
     a_list = None
     if   n < 53*53:
+        if __stats_on:
+            __stat('probably_prime.calls')
+            __stat('probably_prime.branch.below_2809')
         return True
     elif n < 1373653:
+        branch = 'mr_below_1373653'
         upto = 3
     elif n < 9080191:
+        branch = 'mr_below_9080191'
         a_list = [31, 73]
     elif n < 170584961:
+        branch = 'mr_below_170584961'
         a_list = [350, 3958281543]
     elif n < 4759123141:
+        branch = 'mr_below_4759123141'
         a_list = [2, 7, 61]
     elif n < 75792980677:
+        branch = 'mr_below_75792980677'
         a_list = [2, 379215, 457083754]
 #   elif n < 118670087467:
 #       if n == 3215031751:
@@ -394,19 +544,24 @@ def probably_prime(n):
 #   elif n < 3474749660383:
 #       upto = 13
     elif n < 21652684502221:
+        branch = 'mr_below_21652684502221'
         a_list = [2, 1215, 34862, 574237825]
     elif n < 341550071728321:
+        branch = 'mr_below_341550071728321'
         upto = 17
     elif n < 3825123056546413051:
+        branch = 'mr_below_3825123056546413051'
         upto = 23
     elif n < 3317044064679887385961981:
+        branch = 'mr_below_3317044064679887385961981'
         upto = 41
     else:
         # this is where the "probably" prime kicks in
+        branch = 'mr_probable'
         upto = 47
 
     if not a_list:
-        a_list = primes_to(upto)
+        a_list = __small_primes(upto)
 
     # Miller-Rabin primality test, always correct up limits shown
     d = n-1
@@ -415,7 +570,10 @@ def probably_prime(n):
         d >>= 1
         r += 1
 
+    witnesses = 0
+    is_prime = True
     for a in a_list:
+        witnesses += 1
         x = powmod(a, d, n)
         if x != 1 and x != n-1:
             for y in range(r-1):
@@ -423,8 +581,14 @@ def probably_prime(n):
                 if x == n-1:
                     break
             else:
-                return False
-    return True
+                is_prime = False
+                break
+
+    if __stats_on:
+        __stat('probably_prime.calls')
+        __stat('probably_prime.branch.' + branch)
+        __stat('probably_prime.witnesses', witnesses)
+    return is_prime
 
 
 def next_probably_prime(n):
@@ -499,6 +663,255 @@ def carmichael_lambda_list(ns):
         (power(p,c) for p,c in p2c.items()),
         1)
 
+def __bsgs_log(g, h, n, m):
+    """
+    Baby-step giant-step, solve g^x = h mod m where g has order n
+    memory is bounded by BSGS_LIMIT, the number of giant steps grows to compensate
+
+    :return: x with 0 <= x < n, or None if there is no solution
+    """
+    steps = int(sqrt(n))+1
+    if steps > BSGS_LIMIT:
+        steps = BSGS_LIMIT
+
+    # baby steps, g^j for 0 <= j < steps
+    table = {}
+    x = 1
+    for j in range(steps):
+        if x not in table:
+            table[x] = j
+        x = x*g % m
+
+    # giant steps, h*g^(-i*steps)
+    giant = mult_inverse(x, m)
+    y = h
+    for i in range((n + steps - 1)//steps):
+        j = table.get(y)
+        if j is not None:
+            return i*steps + j
+        y = y*giant % m
+    return None
+
+def __rho_log(g, h, n, m):
+    """
+    Pollard's rho for logarithms, solve g^x = h mod m where g has prime order n
+    uses constant memory
+
+    :return: x with 0 <= x < n, or None if no solution was found
+    """
+    for attempt in range(8):
+        # random starting point x = g^a * h^b
+        a = randbelow(n)
+        b = randbelow(n)
+        x = powmod(g, a, m) * powmod(h, b, m) % m
+        xx, aa, bb = x, a, b
+
+        # Floyd cycle finding, the tortoise (x) takes one step, the hare (xx) two
+        while True:
+            s = x % 3
+            if s == 0:
+                x = x*x % m
+                a = 2*a % n
+                b = 2*b % n
+            elif s == 1:
+                x = x*g % m
+                a = (a+1) % n
+            else:
+                x = x*h % m
+                b = (b+1) % n
+            for step in range(2):
+                s = xx % 3
+                if s == 0:
+                    xx = xx*xx % m
+                    aa = 2*aa % n
+                    bb = 2*bb % n
+                elif s == 1:
+                    xx = xx*g % m
+                    aa = (aa+1) % n
+                else:
+                    xx = xx*h % m
+                    bb = (bb+1) % n
+            if x == xx:
+                break
+
+        # g^a * h^b = g^aa * h^bb, so x * (bb-b) = a-aa mod n
+        r = (bb - b) % n
+        if r:
+            return (a - aa) * mult_inverse(r, n) % n
+    return None
+
+def __prime_log(g, h, p, m):
+    """
+    Solve g^x = h mod m where g has prime order p
+    """
+    if p <= BSGS_LIMIT*BSGS_LIMIT:
+        return __bsgs_log(g, h, p, m)
+    return __rho_log(g, h, p, m)
+
+def __prime_power_log(g, h, p, c, m):
+    """
+    Solve g^x = h mod m where g has order p^c, one base p digit of x at a time
+    """
+    gamma = powmod(g, power(p, c-1), m)
+    g_inv = mult_inverse(g, m)
+    x = 0
+    pk = 1
+    for k in range(c):
+        hk = powmod(powmod(g_inv, x, m) * h % m, power(p, c-1-k), m)
+        d = __prime_log(gamma, hk, p, m)
+        if d is None:
+            return None
+        x += d*pk
+        pk *= p
+    return x
+
+def __factor_order(n):
+    """
+    factor(n), trial dividing only up to BSGS_LIMIT when what is left is prime
+    group orders discrete_log is fast for are like that, e.g. p-1 for a large prime p
+    """
+    factors = factor(n, BSGS_LIMIT)
+    if factors and factors[-1][1] >= BSGS_LIMIT and not probably_prime(factors[-1][1]):
+        # what is left is composite, factor it all the way
+        factors = factors[:-1] + factor(factors[-1][1])
+    return factors
+
+def discrete_log(g, h, m):
+    """
+    Compute the discrete logarithm, the smallest x >= 0 where g^x = h mod m
+    Uses Pohlig-Hellman over the factored order of g, solving each prime subgroup with
+    baby-step giant-step, or Pollard's rho when the prime is too large for a BSGS table.
+    note that this becomes increasingly CPU intensive as the largest factor of the order of g becomes larger
+
+    :param g: the base
+    :param h: the target value
+    :param m: the modulus
+    :return: x, or None if there is no solution
+    """
+    g %= m
+    h %= m
+
+    # divide out the factors g shares with m, solving k * g^x = h mod m
+    k = 1 % m
+    shift = 0
+    while True:
+        d = gcd(g, m)
+        if d == 1:
+            break
+        if h == k:
+            return shift
+        if h % d:
+            return None
+        h //= d
+        m //= d
+        k = k * (g//d) % m
+        shift += 1
+    if m == 1:
+        return shift
+    h = h * mult_inverse(k, m) % m
+
+    # find the order of g, a divisor of carmichael_lambda(m), which is m-1 for a prime
+    if probably_prime(m):
+        order = m-1
+    else:
+        order = carmichael_lambda(m)
+    order_factors = []
+    for c, p in __factor_order(order):
+        while c and powmod(g, order//p, m) == 1:
+            order //= p
+            c -= 1
+        if c:
+            order_factors.append((c, p))
+
+    # Pohlig-Hellman, solve x mod p^c in each prime power subgroup
+    residues = []
+    moduli = []
+    for c, p in order_factors:
+        pc = power(p, c)
+        e = order // pc
+        r = __prime_power_log(powmod(g, e, m), powmod(h, e, m), p, c, m)
+        if r is None:
+            return None
+        residues.append(r)
+        moduli.append(pc)
+    x = crt(residues, moduli)
+
+    if powmod(g, x, m) != h:
+        return None
+    return x + shift
+
+class CRTBasis(object):
+    """
+    A set of moduli prepared for Chinese Remainder Theorem reconstruction
+    The Garner coefficients are computed once, so each reconstruction is only multiply-adds.
+    Moduli do not need to be coprime, residues that disagree on a shared factor have no solution.
+    """
+
+    def __init__(self, moduli):
+        """
+        :param moduli: list of positive integers
+        """
+        self.moduli = list(moduli)
+
+        # for each modulus m[i], with L = lcm(m[0..i-1]) and g = gcd(L, m[i]):
+        #   g, m[i]/g, inverse(L/g) mod m[i]/g, and L[j] mod m[i] for each earlier L[j]
+        self.__coefficients = []
+        self.__radices = []
+        radix = 1
+        for m in self.moduli:
+            g = gcd(radix, m)
+            step = m // g
+            inverse = mult_inverse((radix // g) % step, step) if step > 1 else 0
+            radix_mods = [r % m for r in self.__radices]
+            self.__coefficients.append((m, g, step, inverse, radix_mods))
+            self.__radices.append(radix)
+            radix *= step
+
+        self.modulus = radix
+
+    def reconstruct(self, residues):
+        """
+        Find x where x = residues[i] mod moduli[i] for every i
+
+        :param residues: list of integers, one per modulus
+        :return: x with 0 <= x < lcm(moduli), or None if the residues are inconsistent
+        """
+        digits = []
+        for r, (m, g, step, inverse, radix_mods) in zip(residues, self.__coefficients):
+            # x so far, mod m, from the mixed radix digits
+            s = r
+            for d, rm in zip(digits, radix_mods):
+                s -= d*rm
+            s %= m
+            if s % g:
+                return None
+            digits.append((s//g) * inverse % step)
+
+        x = 0
+        for d, radix in zip(digits, self.__radices):
+            x += d*radix
+        return x
+
+    def reconstruct_all(self, residue_lists):
+        """
+        Reconstruct many residue lists against this basis
+
+        :param residue_lists: iterable of lists of residues
+        :return: list of reconstructed values (None for inconsistent residues)
+        """
+        return [self.reconstruct(residues) for residues in residue_lists]
+
+def crt(residues, moduli):
+    """
+    Chinese Remainder Theorem, find x where x = residues[i] mod moduli[i] for every i
+    the moduli do not need to be coprime
+
+    :param residues: list of integers
+    :param moduli: list of positive integers
+    :return: x with 0 <= x < lcm(moduli), or None if there is no solution
+    """
+    return CRTBasis(moduli).reconstruct(residues)
+
 __sieve_Eratosthenes(1000*1000)
 
 if __name__ == '__main__':
@@ -507,6 +920,32 @@ if __name__ == '__main__':
         for i in range(1, p):
             print("multiplicative inverse of %d mod %d = %d"%(i, p, mult_inverse(i, p)))
 
+    if True:
+        x = discrete_log(3, 13, 17)
+        print("discrete log of 13 base 3 mod 17 = %d"%x)
+        if x != 4:
+            raise Exception("discrete log incorrect")
+        if discrete_log(2, 3, 7) is not None:
+            raise Exception("discrete log found for a value outside the subgroup")
+
+    if True:
+        x = crt([2, 3, 2], [3, 5, 7])
+        print("x = 2 mod 3, 3 mod 5, 2 mod 7: x = %d"%x)
+        if x != 23:
+            raise Exception("crt incorrect")
+        if crt([1, 2], [4, 6]) is not None:
+            raise Exception("crt found a solution for inconsistent residues")
+
+    if True:
+        stats_enable()
+        factor(600851475143)
+        s = stats()
+        stats_enable(False)
+        print("factor 600851475143: %d trial divisions, %d Miller-Rabin rounds"%(
+            s['factor.trial_divisions'], s.get('probably_prime.witnesses', 0)))
+        if s['factor.calls'] != 1:
+            raise Exception("statistics incorrect")
+
     if False:
         PCL = 300*1000*1000
         p_sum = 0
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the numtheory hot paths, with a history of results and regression checks.
+
+usage: numtheory_bench.py [-baseline] [-history=FILE] [-threshold=FRACTION] [name ...]
+
+    -baseline             store this run as the baseline that later runs are compared against
+    -history=FILE         JSON file to record results in (default numtheory_bench.json)
+    -threshold=FRACTION   how much slower than the baseline counts as a regression (default 0.25)
+    name ...              only run benchmarks whose name starts with one of these
+
+the exit status is 1 if any benchmark regressed against the baseline
+"""
+
+import sys
+import json
+import time
+import random
+import platform
+from datetime import datetime
+
+import numtheory as nt
+
+HISTORY_FILE = 'numtheory_bench.json'
+THRESHOLD = 0.25
+
+########################################
+# Timing
+########################################
+
+def measure(func, setup=None, repeat=5, number=1):
+    """
+    Time func, returning the best time per call in seconds over repeat runs
+
+    :param func: the code to time, called with no arguments
+    :param setup: called before each run, not timed
+    :param repeat: how many runs to take the best of
+    :param number: how many calls to func in each run
+    """
+    best = None
+    for r in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        for n in range(number):
+            func()
+        t = (time.perf_counter() - t0) / number
+        if best is None or t < best:
+            best = t
+    return best
+
+########################################
+# Prime cache control
+########################################
+
+saved_primes = getattr(nt, '__primes')
+
+def empty_prime_cache():
+    "Start the sieve over, so that it must expand from nothing"
+    setattr(nt, '__primes', [2, 3])
+
+def restore_prime_cache():
+    setattr(nt, '__primes', saved_primes)
+
+########################################
+# Benchmarks
+########################################
+
+def bench_sieve(limit):
+    sieve = getattr(nt, '__sieve_Eratosthenes')
+    try:
+        return measure(lambda: sieve(limit), setup=empty_prime_cache, repeat=3)
+    finally:
+        restore_prime_cache()
+
+def bench_primes_to(limit):
+    list(nt.primes_to(limit))
+    return measure(lambda: sum(nt.primes_to(limit)), repeat=3)
+
+def random_odd(rand, bits):
+    return rand.getrandbits(bits) | (1 << (bits-1)) | 1
+
+def bench_probably_prime(bits):
+    rand = random.Random(bits)
+    ns = [random_odd(rand, bits) for i in range(200)]
+    ns += [nt.next_probably_prime(n) for n in ns[:50]]
+    return measure(lambda: [nt.probably_prime(n) for n in ns]) / len(ns)
+
+def bench_factor(n):
+    return measure(lambda: nt.factor(n))
+
+def bench_powmod(bits):
+    rand = random.Random(bits)
+    n = rand.getrandbits(bits)
+    e = rand.getrandbits(bits)
+    m = random_odd(rand, bits)
+    return measure(lambda: nt.powmod(n, e, m), number=10)
+
+def bench_gcd(bits):
+    rand = random.Random(bits)
+    pairs = [(rand.getrandbits(bits), rand.getrandbits(bits)) for i in range(100)]
+    return measure(lambda: [nt.gcd(a, b) for a, b in pairs]) / len(pairs)
+
+def bench_mult_inverse(bits):
+    rand = random.Random(bits)
+    m = nt.next_probably_prime(rand.getrandbits(bits))
+    values = [rand.randrange(1, m) for i in range(100)]
+    return measure(lambda: [nt.mult_inverse(a, m) for a in values]) / len(values)
+
+BENCHMARKS = [
+    ('sieve_1M', lambda: bench_sieve(1000*1000)),
+    ('sieve_3M', lambda: bench_sieve(3*1000*1000)),
+    ('sieve_10M', lambda: bench_sieve(10*1000*1000)),
+    ('primes_to_2M', lambda: bench_primes_to(2*1000*1000)),
+    ('probably_prime_32', lambda: bench_probably_prime(32)),
+    ('probably_prime_64', lambda: bench_probably_prime(64)),
+    ('probably_prime_128', lambda: bench_probably_prime(128)),
+    ('probably_prime_512', lambda: bench_probably_prime(512)),
+    # factor sieves up to sqrt(n), so keep n small enough to stay in the prime cache
+    ('factor_smooth', lambda: bench_factor(2**10 * 3**5 * 5**3 * 7**2 * 11)),
+    # product of two primes near 2^20, trial division runs all the way to sqrt(n)
+    ('factor_hard', lambda: bench_factor(1048573 * 1048571)),
+    ('powmod_1024', lambda: bench_powmod(1024)),
+    ('gcd_1024', lambda: bench_gcd(1024)),
+    ('mult_inverse_1024', lambda: bench_mult_inverse(1024)),
+]
+
+########################################
+# History
+########################################
+
+def load_history(file_name):
+    try:
+        with open(file_name) as open_file:
+            return json.load(open_file)
+    except FileNotFoundError:
+        return {'baseline': {}, 'runs': []}
+
+def save_history(file_name, history):
+    with open(file_name, 'w') as open_file:
+        json.dump(history, open_file, indent=1, sort_keys=True)
+
+def run(names, history_file, threshold, set_baseline):
+    history = load_history(history_file)
+    baseline = history['baseline']
+
+    results = {}
+    regressions = []
+    for name, bench in BENCHMARKS:
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        seconds = bench()
+        results[name] = seconds
+
+        note = ''
+        if name in baseline:
+            ratio = seconds / baseline[name]
+            note = '%6.2fx baseline'%ratio
+            if ratio > 1 + threshold:
+                note += '  REGRESSION'
+                regressions.append(name)
+        print('%-20s %12.3f us  %s'%(name, seconds * 1e6, note))
+
+    history['runs'].append({
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'results': results,
+        })
+    if set_baseline:
+        baseline.update(results)
+    save_history(history_file, history)
+
+    if regressions:
+        print('regressions: ' + ', '.join(regressions))
+    return regressions
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    history_file = HISTORY_FILE
+    threshold = THRESHOLD
+    set_baseline = False
+    names = []
+    for arg in args:
+        if arg == '-baseline':
+            set_baseline = True
+        elif arg.startswith('-history='):
+            history_file = arg[len('-history='):]
+        elif arg.startswith('-threshold='):
+            threshold = float(arg[len('-threshold='):])
+        elif arg.startswith('-'):
+            print(__doc__)
+            sys.exit(2)
+        else:
+            names.append(arg)
+
+    if run(names, history_file, threshold, set_baseline):
+        sys.exit(1)
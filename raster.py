@@ -0,0 +1,154 @@
+"""
+Antialiased drawing of thick polylines into a numpy image buffer, with no display.
+
+Coordinates are a turtle's: the origin is the center of the image and y is up.
+"""
+
+import numpy as np
+
+# segments are drawn at a time in tiles of up to about this many pixels
+BATCH_PIXELS = 1 << 20
+
+# the sizes of the tiles segments are drawn in are multiples of this
+TILE_STEP = 4
+
+class Raster(object):
+    """
+    An RGB image of floats from 0 to 1, which polylines are drawn over
+    """
+
+    def __init__(self, width, height, background=(0.0, 0.0, 0.0)):
+        self.width = width
+        self.height = height
+        self.pixels = np.empty((height * width, 3))
+        self.pixels[:] = background
+        # like a turtle's pen, lines drawn without colors are the last color used
+        self.pen_color = (0.0, 0.0, 0.0)
+        # the coverage of the polyline being drawn, and the segment covering most of each pixel
+        self.coverage = np.zeros(height * width)
+        self.segment = np.zeros(height * width, dtype=np.intp)
+
+    def draw_polyline(self, xs, ys, widths, colors=None, visible=None):
+        """
+        Draw the segments between successive points, each with the width and color of
+        the point it ends at, as a turtle going to each point in turn draws them
+
+        Where segments of the polyline overlap, each pixel is the color of the segment
+        covering most of it, so the joints aren't drawn twice.
+
+        :param xs: x of each point
+        :param ys: y of each point
+        :param widths: line width of each point, or one width for all of them
+        :param colors: array of the (r, g, b) of each point, None for pen_color
+        :param visible: if given, segments ending at a point where it is False are skipped
+        """
+        xs = np.asarray(xs, dtype=float)
+        if len(xs) < 2:
+            return
+        ys = np.asarray(ys, dtype=float)
+        radii = np.broadcast_to(np.asarray(widths, dtype=float) / 2, xs.shape)[1:]
+        if colors is None:
+            colors = np.array([self.pen_color])
+            color_index = np.zeros(len(xs) - 1, dtype=np.intp)
+        else:
+            colors = np.asarray(colors, dtype=float)
+            self.pen_color = tuple(colors[-1])
+            colors = colors[1:]
+            color_index = np.arange(len(xs) - 1)
+
+        # pixel coordinates, with pixel centers at whole numbers
+        x0 = xs[:-1] + (self.width / 2 - 0.5)
+        y0 = (self.height / 2 - 0.5) - ys[:-1]
+        x1 = xs[1:] + (self.width / 2 - 0.5)
+        y1 = (self.height / 2 - 0.5) - ys[1:]
+        if visible is not None:
+            keep = np.asarray(visible, dtype=bool)[1:]
+            x0, y0, x1, y1, radii, color_index = (
+                    a[keep] for a in (x0, y0, x1, y1, radii, color_index))
+
+        # the box of pixels each segment may cover
+        reach = radii + 1
+        left = np.maximum(np.floor(np.minimum(x0, x1) - reach), 0).astype(np.intp)
+        right = np.minimum(np.ceil(np.maximum(x0, x1) + reach), self.width - 1).astype(np.intp)
+        top = np.maximum(np.floor(np.minimum(y0, y1) - reach), 0).astype(np.intp)
+        bottom = np.minimum(np.ceil(np.maximum(y0, y1) + reach), self.height - 1).astype(np.intp)
+        rows = bottom - top + 1
+        columns = right - left + 1
+        on_image = (rows > 0) & (columns > 0)
+
+        # segment geometry relative to the corner of its box
+        geometry = (
+                left, top,
+                (left - x0).astype(np.float32), (top - y0).astype(np.float32),
+                (x1 - x0).astype(np.float32), (y1 - y0).astype(np.float32),
+                (radii + 0.5).astype(np.float32))
+
+        # segments are covered together, in tiles of the same size, which are
+        # their boxes rounded up to TILE_STEP
+        tile_rows = -(-rows // TILE_STEP) * TILE_STEP
+        tile_columns = -(-columns // TILE_STEP) * TILE_STEP
+        tiles = tile_rows * (self.width + TILE_STEP) + tile_columns
+        touched = []
+        for tile in np.unique(tiles[on_image]).tolist():
+            group = np.nonzero(on_image & (tiles == tile))[0]
+            tile_size = divmod(tile, self.width + TILE_STEP)
+            per_batch = max(1, BATCH_PIXELS // (tile_size[0] * tile_size[1]))
+            for start in range(0, len(group), per_batch):
+                touched.append(self.__cover(group[start:start + per_batch], tile_size, geometry))
+        if not touched:
+            return
+
+        touched = np.unique(np.concatenate(touched))
+        coverage = self.coverage[touched, None]
+        self.pixels[touched] = (self.pixels[touched] * (1 - coverage)
+                + colors[color_index[self.segment[touched]]] * coverage)
+        self.coverage[touched] = 0.0
+
+    def __cover(self, segments, tile_size, geometry):
+        """
+        Add the pixels covered by segments, each within a tile of tile_size pixels from
+        the corner of its box, to coverage and segment
+
+        :return: the flat indexes of the pixels
+        """
+        left, top, x_offset, y_offset, dx, dy, radii = (
+                a[segments, None, None] for a in geometry)
+        row = np.arange(tile_size[0])[:, None]
+        column = np.arange(tile_size[1])
+
+        # distance from each pixel to the closest point of its segment, from its start
+        rx = x_offset + column.astype(np.float32)
+        ry = y_offset + row.astype(np.float32)
+        along = np.clip((rx * dx + ry * dy) / np.maximum(dx * dx + dy * dy, np.float32(1e-12)),
+                0.0, 1.0)
+        rx = rx - along * dx
+        ry = ry - along * dy
+        coverage = radii - np.sqrt(rx * rx + ry * ry)
+
+        px = left + column
+        py = top + row
+        covered = (coverage > 0) & (px < self.width) & (py < self.height)
+        flat = (py * self.width + px)[covered]
+        coverage = np.minimum(coverage[covered], 1.0)
+        segments = np.broadcast_to(segments[:, None, None], covered.shape)[covered]
+
+        # ties go to the later segment, which a turtle draws over the earlier
+        current = self.coverage[flat]
+        covered = (coverage > current) | ((coverage == current) & (segments > self.segment[flat]))
+        flat = flat[covered]
+        coverage = coverage[covered]
+        segments = segments[covered]
+        # with repeated indexes the last assignment wins, so assign the most coverage last
+        order = np.lexsort((segments, coverage))
+        self.coverage[flat[order]] = coverage[order]
+        self.segment[flat[order]] = segments[order]
+        return flat
+
+    def to_image(self):
+        "The pixels as a PIL Image"
+        from PIL import Image
+        pixels = np.rint(np.clip(self.pixels, 0.0, 1.0) * 255).astype(np.uint8)
+        return Image.fromarray(pixels.reshape((self.height, self.width, 3)), "RGB")
+
+    def save(self, file_name):
+        self.to_image().save(file_name)
@@ -0,0 +1,555 @@
+"""
+SparseBitMap, a compressed bitmap for huge, sparse sets of integers
+
+The bit positions are split into chunks of 2^16 bits, and each chunk is stored in whichever
+container is smallest for what it holds:
+    array   a sorted array of the positions set, for chunks with few bits set
+    bitmap  a BitMap of the whole chunk, for chunks with many bits set
+    run     a list of runs of consecutive bits set, for chunks made of long ranges
+Chunks with no bits set are not stored at all, so memory follows the number of bits set
+rather than the largest position.
+"""
+
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+from bitmap import BitMap
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+LOW_MASK = CHUNK_SIZE - 1
+
+# an array container holds at most this many positions, beyond it a bitmap is smaller
+ARRAY_LIMIT = 4096
+
+ARRAY = 0
+BITMAP = 1
+RUN = 2
+
+# serialized SparseBitMaps are this header, followed by each chunk
+FILE_MAGIC = b"SBMP"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<4sB3xQ")      # magic, version, number of chunks
+CHUNK_HEADER = struct.Struct("<QBI")        # key, kind, number of entries
+
+########################################
+# Containers
+########################################
+
+def _bitmap_of_int(value):
+    bm = BitMap()
+    bm.bitmap = bytearray(value.to_bytes(CHUNK_SIZE // 8, 'little'))
+    return bm
+
+def _from_bitmap(bm, card=None):
+    """
+    The best of an array or bitmap container for the bits in bm, None if no bits are set
+    """
+    if card is None:
+        card = bm.count()
+    if card == 0:
+        return None
+    if card <= ARRAY_LIMIT:
+        return _ArrayChunk(bm.iter_set())
+    return _BitmapChunk(bm, card)
+
+
+class _ArrayChunk(object):
+    kind = ARRAY
+
+    def __init__(self, values=()):
+        self.values = array('H', values)
+
+    def copy(self):
+        return _ArrayChunk(self.values)
+
+    def cardinality(self):
+        return len(self.values)
+
+    def contains(self, low):
+        values = self.values
+        i = bisect_left(values, low)
+        return i < len(values) and values[i] == low
+
+    def add(self, low):
+        values = self.values
+        i = bisect_left(values, low)
+        if i < len(values) and values[i] == low:
+            return self
+        if len(values) >= ARRAY_LIMIT:
+            return _BitmapChunk(self.to_bitmap(), len(values)).add(low)
+        values.insert(i, low)
+        return self
+
+    def remove(self, low):
+        values = self.values
+        i = bisect_left(values, low)
+        if i < len(values) and values[i] == low:
+            del values[i]
+        return self
+
+    def iter_low(self, start, stop):
+        values = self.values
+        return iter(values[bisect_left(values, start):bisect_left(values, stop)])
+
+    def to_bitmap(self):
+        bm = BitMap(CHUNK_SIZE)
+        for low in self.values:
+            bm.set(low)
+        return bm
+
+    def entries(self):
+        return len(self.values)
+
+    def payload(self):
+        return struct.pack("<%dH" % len(self.values), *self.values)
+
+    @classmethod
+    def from_payload(cls, entries, data):
+        return cls(struct.unpack("<%dH" % entries, data))
+
+
+class _BitmapChunk(object):
+    kind = BITMAP
+
+    def __init__(self, bm, card):
+        self.bm = bm
+        self.card = card
+
+    def copy(self):
+        return _BitmapChunk(self.to_bitmap(), self.card)
+
+    def cardinality(self):
+        return self.card
+
+    def contains(self, low):
+        return self.bm.test(low)
+
+    def add(self, low):
+        if not self.bm.test(low):
+            self.bm.set(low)
+            self.card += 1
+        return self
+
+    def remove(self, low):
+        if self.bm.test(low):
+            self.bm.reset(low)
+            self.card -= 1
+            if self.card <= ARRAY_LIMIT:
+                return _from_bitmap(self.bm, self.card) or _ArrayChunk()
+        return self
+
+    def iter_low(self, start, stop):
+        return self.bm.iter_set(start, stop)
+
+    def to_bitmap(self):
+        bm = BitMap()
+        bm.bitmap = bytearray(self.bm.bitmap)
+        return bm
+
+    def entries(self):
+        return len(self.bm.bitmap)
+
+    def payload(self):
+        return bytes(self.bm.bitmap)
+
+    @classmethod
+    def from_payload(cls, entries, data):
+        bm = BitMap()
+        bm.bitmap = bytearray(data)
+        return cls(bm, bm.count())
+
+
+class _RunChunk(object):
+    kind = RUN
+
+    def __init__(self, runs):
+        """
+        :param runs: sorted list of non-overlapping (first, last) inclusive runs of bits set
+        """
+        self.runs = list(runs)
+        self.starts = [first for first, last in self.runs]
+
+    def copy(self):
+        return _RunChunk(self.runs)
+
+    def cardinality(self):
+        return sum(last - first + 1 for first, last in self.runs)
+
+    def contains(self, low):
+        i = bisect_right(self.starts, low) - 1
+        return i >= 0 and low <= self.runs[i][1]
+
+    def add(self, low):
+        if self.contains(low):
+            return self
+        return _from_bitmap(self.to_bitmap()).add(low)
+
+    def remove(self, low):
+        if not self.contains(low):
+            return self
+        return (_from_bitmap(self.to_bitmap()) or _ArrayChunk()).remove(low)
+
+    def iter_low(self, start, stop):
+        for first, last in self.runs:
+            if last < start:
+                continue
+            if first >= stop:
+                break
+            yield from range(max(first, start), min(last + 1, stop))
+
+    def to_bitmap(self):
+        bm = BitMap(CHUNK_SIZE)
+        for first, last in self.runs:
+            bm.set_range(first, last + 1)
+        return bm
+
+    def entries(self):
+        return len(self.runs)
+
+    def payload(self):
+        return struct.pack("<%dH" % (2 * len(self.runs)),
+                *(bound for run in self.runs for bound in run))
+
+    @classmethod
+    def from_payload(cls, entries, data):
+        bounds = struct.unpack("<%dH" % (2 * entries), data)
+        return cls(zip(bounds[0::2], bounds[1::2]))
+
+
+CHUNK_TYPES = {ARRAY: _ArrayChunk, BITMAP: _BitmapChunk, RUN: _RunChunk}
+
+def _runs_of(bm):
+    """
+    The runs of consecutive bits set in a chunk sized BitMap, as (first, last) pairs
+    """
+    value = int.from_bytes(bm.bitmap, 'little')
+    firsts = _bitmap_of_int(value & ~(value << 1))
+    lasts = _bitmap_of_int(value & ~(value >> 1))
+    return list(zip(firsts.iter_set(), lasts.iter_set()))
+
+def _optimized(chunk):
+    """
+    The smallest container for the bits in chunk
+    """
+    bm = chunk.to_bitmap()
+    card = chunk.cardinality()
+    runs = _runs_of(bm)
+    run_size = 4 * len(runs)
+    array_size = 2 * card if card <= ARRAY_LIMIT else CHUNK_SIZE
+    if run_size < array_size and run_size < CHUNK_SIZE // 8:
+        return _RunChunk(runs)
+    return _from_bitmap(bm, card)
+
+def _union(a, b):
+    if a.kind == ARRAY and b.kind == ARRAY:
+        values = sorted(set(a.values).union(b.values))
+        if len(values) <= ARRAY_LIMIT:
+            return _ArrayChunk(values)
+    bm = a.to_bitmap()
+    bm |= b.to_bitmap()
+    return _from_bitmap(bm)
+
+def _intersection(a, b):
+    if b.kind == ARRAY:
+        a, b = b, a
+    if a.kind == ARRAY:
+        values = [low for low in a.values if b.contains(low)]
+        return _ArrayChunk(values) if values else None
+    bm = a.to_bitmap()
+    bm &= b.to_bitmap()
+    return _from_bitmap(bm)
+
+########################################
+# SparseBitMap
+########################################
+
+class SparseBitMap(object):
+    """
+    Compressed bitmap, with the same set/test/count/iteration API as BitMap
+    positions may be any non-negative integer, there is no fixed size
+    """
+
+    def __init__(self, positions=()):
+        """
+        Create a SparseBitMap, with the bits at positions set
+        """
+        self.__chunks = {}
+        for pos in positions:
+            self.set(pos)
+
+    def set(self, pos):
+        """
+        Set the value of bit@pos to 1
+        """
+        key = pos >> CHUNK_BITS
+        chunk = self.__chunks.get(key)
+        if chunk is None:
+            self.__chunks[key] = _ArrayChunk([pos & LOW_MASK])
+        else:
+            self.__chunks[key] = chunk.add(pos & LOW_MASK)
+
+    def reset(self, pos):
+        """
+        Reset the value of bit@pos to 0
+        """
+        key = pos >> CHUNK_BITS
+        chunk = self.__chunks.get(key)
+        if chunk is not None:
+            chunk = chunk.remove(pos & LOW_MASK)
+            if chunk.cardinality():
+                self.__chunks[key] = chunk
+            else:
+                del self.__chunks[key]
+
+    def flip(self, pos):
+        """
+        Flip the value of bit@pos
+        """
+        if self.test(pos):
+            self.reset(pos)
+        else:
+            self.set(pos)
+
+    def test(self, pos):
+        """
+        Return bit value
+        """
+        chunk = self.__chunks.get(pos >> CHUNK_BITS)
+        return chunk is not None and chunk.contains(pos & LOW_MASK)
+
+    def set_range(self, start, stop, step=1):
+        """
+        Set the value of the bits at range(start, stop, step) to 1
+        """
+        self.__range(start, stop, step, True)
+
+    def clear_range(self, start, stop, step=1):
+        """
+        Reset the value of the bits at range(start, stop, step) to 0
+        """
+        self.__range(start, stop, step, False)
+
+    def __range(self, start, stop, step, value):
+        if step <= 0:
+            raise Exception("step must be positive")
+        if start >= stop:
+            return
+        chunks = self.__chunks
+        for key in range(start >> CHUNK_BITS, ((stop - 1) >> CHUNK_BITS) + 1):
+            base = key << CHUNK_BITS
+            first = start if start >= base else start + (base - start + step - 1) // step * step
+            end = min(stop, base + CHUNK_SIZE)
+            if first >= end:
+                continue
+            chunk = chunks.get(key)
+
+            if step == 1 and (chunk is None or (first == base and end == base + CHUNK_SIZE)):
+                # a single run, either the whole chunk or all there is in it
+                if value:
+                    chunks[key] = _RunChunk([(first - base, end - 1 - base)])
+                elif chunk is not None:
+                    del chunks[key]
+                continue
+            if chunk is None and not value:
+                continue
+
+            bm = chunk.to_bitmap() if chunk is not None else BitMap(CHUNK_SIZE)
+            if value:
+                bm.set_range(first - base, end - base, step)
+            else:
+                bm.clear_range(first - base, end - base, step)
+            chunk = _from_bitmap(bm)
+            if chunk is None:
+                del chunks[key]
+            else:
+                chunks[key] = chunk
+
+    def optimize(self):
+        """
+        Convert each chunk to its smallest container, including run containers
+        worthwhile after building a SparseBitMap with long ranges of bits set
+        """
+        for key, chunk in self.__chunks.items():
+            self.__chunks[key] = _optimized(chunk)
+
+    def count(self):
+        """
+        Count bits set
+        """
+        return sum(chunk.cardinality() for chunk in self.__chunks.values())
+
+    def any(self):
+        """
+        Test if any bit is set
+        """
+        return bool(self.__chunks)
+
+    def none(self):
+        """
+        Test if no bit is set
+        """
+        return not self.__chunks
+
+    def iter_set(self, start=0, stop=None):
+        """
+        Iterate over the positions of bits set, in ascending order
+        """
+        for key in sorted(self.__chunks):
+            base = key << CHUNK_BITS
+            if base + CHUNK_SIZE <= start:
+                continue
+            if stop is not None and base >= stop:
+                break
+            low_start = max(start - base, 0)
+            low_stop = CHUNK_SIZE if stop is None else min(stop - base, CHUNK_SIZE)
+            for low in self.__chunks[key].iter_low(low_start, low_stop):
+                yield base + low
+
+    def nonzero(self):
+        """
+        Get all non-zero bits
+        """
+        return list(self.iter_set())
+
+    def container_counts(self):
+        """
+        Return how many chunks use each kind of container, as a dict
+        """
+        counts = {'array': 0, 'bitmap': 0, 'run': 0}
+        names = {ARRAY: 'array', BITMAP: 'bitmap', RUN: 'run'}
+        for chunk in self.__chunks.values():
+            counts[names[chunk.kind]] += 1
+        return counts
+
+    def __getitem__(self, item):
+        """
+        Return a bit when indexing like a array
+        """
+        return self.test(item)
+
+    def __setitem__(self, key, value):
+        """
+        Sets a bit when indexing like a array
+        """
+        if value is True:
+            self.set(key)
+        elif value is False:
+            self.reset(key)
+        else:
+            raise Exception("Use a boolean value to assign to a bitfield")
+
+    def __new_from(self, chunks):
+        sbm = self.__class__()
+        sbm.__chunks = chunks
+        return sbm
+
+    def __union_chunks(self, other):
+        mine = self.__chunks
+        theirs = other.__chunks
+        chunks = {}
+        for key in mine.keys() | theirs.keys():
+            a = mine.get(key)
+            b = theirs.get(key)
+            if a is None:
+                chunks[key] = b.copy()
+            elif b is None:
+                chunks[key] = a.copy()
+            else:
+                chunks[key] = _union(a, b)
+        return chunks
+
+    def __intersection_chunks(self, other):
+        mine = self.__chunks
+        theirs = other.__chunks
+        chunks = {}
+        for key in mine.keys() & theirs.keys():
+            chunk = _intersection(mine[key], theirs[key])
+            if chunk is not None:
+                chunks[key] = chunk
+        return chunks
+
+    def __or__(self, other):
+        """
+        Bits set in either
+        """
+        if not isinstance(other, SparseBitMap):
+            return NotImplemented
+        return self.__new_from(self.__union_chunks(other))
+
+    def __and__(self, other):
+        """
+        Bits set in both
+        """
+        if not isinstance(other, SparseBitMap):
+            return NotImplemented
+        return self.__new_from(self.__intersection_chunks(other))
+
+    def __ior__(self, other):
+        if not isinstance(other, SparseBitMap):
+            return NotImplemented
+        self.__chunks = self.__union_chunks(other)
+        return self
+
+    def __iand__(self, other):
+        if not isinstance(other, SparseBitMap):
+            return NotImplemented
+        self.__chunks = self.__intersection_chunks(other)
+        return self
+
+    def tobytes(self):
+        """
+        Serialize the SparseBitMap, readable with frombytes()
+        """
+        parts = [FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, len(self.__chunks))]
+        for key in sorted(self.__chunks):
+            chunk = self.__chunks[key]
+            parts.append(CHUNK_HEADER.pack(key, chunk.kind, chunk.entries()))
+            parts.append(chunk.payload())
+        return b"".join(parts)
+
+    @classmethod
+    def frombytes(cls, data):
+        """
+        Construct SparseBitMap from the output of tobytes()
+        """
+        data = memoryview(data)
+        if len(data) < FILE_HEADER.size:
+            raise Exception("Invalid sparse bitmap data!")
+        magic, version, nchunks = FILE_HEADER.unpack_from(data)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise Exception("Invalid sparse bitmap data!")
+
+        chunks = {}
+        offset = FILE_HEADER.size
+        for i in range(nchunks):
+            key, kind, entries = CHUNK_HEADER.unpack_from(data, offset)
+            offset += CHUNK_HEADER.size
+            chunk_type = CHUNK_TYPES.get(kind)
+            if chunk_type is None:
+                raise Exception("Invalid sparse bitmap data!")
+            nbytes = {ARRAY: 2 * entries, BITMAP: entries, RUN: 4 * entries}[kind]
+            if offset + nbytes > len(data):
+                raise Exception("Invalid sparse bitmap data!")
+            chunks[key] = chunk_type.from_payload(entries, data[offset:offset + nbytes])
+            offset += nbytes
+
+        sbm = cls()
+        sbm.__chunks = chunks
+        return sbm
+
+    def save(self, path):
+        """
+        Write the SparseBitMap to a binary file, readable with load()
+        """
+        with open(path, "wb") as open_file:
+            open_file.write(self.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a SparseBitMap written by save()
+        """
+        with open(path, "rb") as open_file:
+            return cls.frombytes(open_file.read())